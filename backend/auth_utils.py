@@ -12,7 +12,8 @@ def load_users():
         with open(USER_DB, 'w') as f:
             json.dump({}, f)
     with open(USER_DB, 'r') as f:
-        return json.load(f)
+        content = f.read()
+    return json.loads(content) if content.strip() else {}
 
 def save_users(users):
     with open(USER_DB, 'w') as f:
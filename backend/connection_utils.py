@@ -0,0 +1,150 @@
+# connection_utils.py
+import collections
+import socket
+import sys
+import threading
+
+RECV_BUFFER_SIZE = 4096       # largest frame read in one go from a client
+THREAD_STACK_SIZE = 256 * 1024  # per-connection thread stack (default is 8 MiB)
+INITIAL_PAYLOAD_BUFFER = 64 * 1024  # payload buffers start here and double as data arrives
+MAX_OUTBOX = 1000  # frames posted behind a busy writer before the client counts as stuck
+
+_outbox_lock = threading.Lock()  # guards every Connection.outbox; held only to queue or pop
+
+class Connection:
+    """All server-side state for one client socket.
+
+    Slots keep every instance the same small size with no per-instance dict.
+    Reads land in one reusable buffer rather than a fresh oversized bytes
+    object per recv, and the username is interned so the copies held by the
+    clients dict, the rate limiter and the tracer share a single string.
+    """
+
+    __slots__ = ("sock", "addr", "username", "conn_id", "busy", "buffer", "view", "send_lock", "outbox", "pending")
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.username = None
+        self.conn_id = 0  # trace connection id, 0 when tracing is off
+        self.busy = 0     # file uploads/downloads in progress, guarded by the server lock
+        self.buffer = bytearray(RECV_BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        # Frames come from several threads (broadcasts, file deliveries); one
+        # frame must never land in the middle of another
+        self.send_lock = threading.Lock()
+        self.outbox = None  # deque of frames posted while another thread was writing
+        self.pending = b""  # read past the end of a sized frame, returned by the next recv
+
+    def push_back(self, data):
+        self.pending = bytes(data) + self.pending
+
+    def login(self, username):
+        self.username = sys.intern(username)
+        return self.username
+
+    def recv(self, size=RECV_BUFFER_SIZE):
+        if self.pending:
+            data, self.pending = self.pending[:size], self.pending[size:]
+            if len(data) < size and not self.pending:
+                # What was read past a frame may be only the start of the next
+                # message; add whatever else of it has already arrived
+                try:
+                    count = self.sock.recv_into(self.buffer, min(size - len(data), RECV_BUFFER_SIZE), socket.MSG_DONTWAIT)
+                except BlockingIOError:
+                    count = 0
+                data += self.view[:count]
+            return data
+        # One exact-size copy out of the shared buffer; b"" when the peer closed
+        count = self.sock.recv_into(self.buffer, min(size, RECV_BUFFER_SIZE))
+        return bytes(self.view[:count]) if count else b""
+
+    def recv_exact(self, size, on_chunk=None):
+        """Read `size` bytes into one buffer, calling `on_chunk(count)` after each read.
+
+        The buffer starts small and doubles as data arrives, so a claimed size
+        is never allocated up front. Returns fewer bytes if the peer closes early.
+        """
+        data = bytearray(min(size, max(INITIAL_PAYLOAD_BUFFER, len(self.pending))))
+        received = min(size, len(self.pending))
+        data[:received], self.pending = self.pending[:received], self.pending[received:]
+        while received < size:
+            if received == len(data):
+                data.extend(bytes(min(len(data), size - received)))
+            with memoryview(data) as view:
+                count = self.sock.recv_into(view[received:], min(65536, len(data) - received))
+            if not count:
+                del data[received:]
+                break
+            received += count
+            if on_chunk:
+                on_chunk(count)
+        return data
+
+    def sendall(self, *frames):
+        """Send one or more frames back to back, waiting for any other writer."""
+        self.send_lock.acquire()
+        try:
+            for data in frames:
+                self.sock.sendall(data)
+            self._flush_outbox()
+        finally:
+            self._release()
+
+    def post(self, data):
+        """Send a frame without waiting behind another writer (e.g. a file download).
+
+        If the socket is busy the frame is queued and the writing thread sends
+        it next. A client that falls MAX_OUTBOX frames behind is disconnected.
+        """
+        if self.send_lock.acquire(blocking=False):
+            try:
+                self._flush_outbox()  # anything posted earlier goes first
+                self.sock.sendall(data)
+            finally:
+                self._release()
+            return
+        with _outbox_lock:
+            # Made on demand and dropped once empty: most connections never
+            # see two writers at once
+            if self.outbox is None:
+                self.outbox = collections.deque()
+            self.outbox.append(data)
+            stuck = len(self.outbox) > MAX_OUTBOX
+            if stuck:
+                self.outbox = None
+        if stuck:
+            self.shutdown(socket.SHUT_RDWR)
+        elif self.send_lock.acquire(blocking=False):
+            try:
+                self._flush_outbox()
+            finally:
+                self._release()
+
+    def _flush_outbox(self):
+        # Only called with send_lock held
+        while True:
+            with _outbox_lock:
+                if not self.outbox:
+                    self.outbox = None
+                    return
+                data = self.outbox.popleft()
+            self.sock.sendall(data)
+
+    def _release(self):
+        self.send_lock.release()
+        # A frame posted just before the release found the lock still held
+        while self.outbox and self.send_lock.acquire(blocking=False):
+            try:
+                self._flush_outbox()
+            except OSError:
+                with _outbox_lock:
+                    self.outbox = None
+            finally:
+                self.send_lock.release()
+
+    def shutdown(self, how):
+        self.sock.shutdown(how)
+
+    def close(self):
+        self.sock.close()
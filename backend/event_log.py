@@ -0,0 +1,123 @@
+# event_log.py
+import collections
+import itertools
+import json
+import os
+import threading
+import time
+import metrics_utils
+
+LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+
+EVENT_LOG_PATH = "events.log"
+BUFFER_SIZE = 8192
+FLUSH_INTERVAL = 0.2  # seconds the writer sleeps when the buffer is empty
+MAX_LOG_BYTES = 10 * 1024 * 1024  # rotate events.log past this size
+BACKUP_COUNT = 3  # rotated files kept: events.log.1 (newest) .. events.log.3
+
+# category -> minimum level; categories not listed use DEFAULT_LEVEL
+DEFAULT_LEVEL = "info"
+CATEGORY_LEVELS = {
+    "message": "info",
+    "file": "info",
+    "connection": "info",
+}
+# category -> keep one event in N (high-volume categories only)
+CATEGORY_SAMPLING = {
+    "message": 10,
+    "rate_limit": 10,
+}
+
+class EventLog:
+    """JSON-lines event log written by a background thread.
+
+    `emit` only appends a tuple to a deque, which is atomic under the GIL, so
+    callers never take a lock or touch the file. When the buffer is full the
+    event is dropped and counted instead of blocking. The deque itself is
+    unbounded: threads racing past the check may overshoot the capacity by a
+    few events, but a bounded deque would evict old events without counting
+    them. The file is rotated once it grows past `max_bytes`.
+    """
+
+    def __init__(self, path=EVENT_LOG_PATH, capacity=BUFFER_SIZE, levels=None, sampling=None,
+                 default_level=DEFAULT_LEVEL, max_bytes=MAX_LOG_BYTES, backup_count=BACKUP_COUNT):
+        self.path = path
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.buffer = collections.deque()
+        self.levels = {cat: LEVELS[lvl] for cat, lvl in (CATEGORY_LEVELS if levels is None else levels).items()}
+        self.default_level = LEVELS[default_level]
+        self.sampling = dict(CATEGORY_SAMPLING if sampling is None else sampling)
+        self.sample_counters = {cat: itertools.count() for cat in self.sampling}
+        self.reported_drops = 0
+        self.running = False
+        self.writer = None
+
+    def emit(self, category, level, event, **fields):
+        if LEVELS[level] < self.levels.get(category, self.default_level):
+            return
+        counter = self.sample_counters.get(category)
+        # Warnings and errors are never sampled away
+        if counter is not None and LEVELS[level] < LEVELS["warning"]:
+            if next(counter) % self.sampling[category]:
+                return
+        if len(self.buffer) >= self.capacity:
+            metrics_utils.increment("event_log.dropped")
+            metrics_utils.increment(f"event_log.dropped.{category}")
+            return
+        self.buffer.append((time.time(), category, level, event, fields))
+
+    def start(self):
+        self.running = True
+        self.writer = threading.Thread(target=self._run, name="event-log-writer", daemon=True)
+        self.writer.start()
+
+    def close(self):
+        self.running = False
+        if self.writer:
+            self.writer.join()
+        self._flush()
+
+    def _run(self):
+        while self.running:
+            if not self._flush():
+                time.sleep(FLUSH_INTERVAL)
+
+    def _flush(self):
+        lines = []
+        try:
+            for _ in range(self.capacity):
+                ts, category, level, event, fields = self.buffer.popleft()
+                record = {"ts": round(ts, 6), "cat": category, "lvl": level, "event": event}
+                record.update(fields)
+                lines.append(json.dumps(record, default=str))
+        except IndexError:
+            pass
+        dropped = metrics_utils.get("event_log.dropped")
+        if dropped > self.reported_drops:
+            # Report drops as their own record so overflow is visible in the log
+            lines.append(json.dumps({"ts": round(time.time(), 6), "cat": "event_log", "lvl": "warning",
+                                     "event": "dropped", "count": dropped - self.reported_drops}))
+            self.reported_drops = dropped
+        if not lines:
+            return False
+        with open(self.path, "a") as f:
+            f.write("\n".join(lines) + "\n")
+            size = f.tell()
+        if size > self.max_bytes:
+            self._rotate()
+        return True
+
+    def _rotate(self):
+        # events.log -> events.log.1 -> ... -> events.log.<backup_count>, oldest dropped
+        try:
+            for n in range(self.backup_count - 1, 0, -1):
+                if os.path.exists(f"{self.path}.{n}"):
+                    os.replace(f"{self.path}.{n}", f"{self.path}.{n + 1}")
+            if self.backup_count:
+                os.replace(self.path, f"{self.path}.1")
+            else:
+                os.remove(self.path)
+        except OSError:
+            pass  # keep appending to the current file
@@ -0,0 +1,387 @@
+# federation.py
+import collections
+import hashlib
+import hmac
+import json
+import os
+import socket
+import struct
+import threading
+import time
+
+PEER_PORT = 6000
+SECRET_ENV = "CHAT_PEER_SECRET"  # shared by every node; links that cannot prove it are dropped
+RECONNECT_INTERVAL = 2.0   # seconds between attempts to re-dial a lost peer
+DIGEST_INTERVAL = 10.0     # seconds between presence digests
+CHUNK_SIZE = 64 * 1024     # file bodies are split so chat frames can overtake them
+
+# Frame: header length, body length, JSON header, raw body
+FRAME = struct.Struct("!II")
+
+def presence_digest(users):
+    return hashlib.sha256("\n".join(sorted(users)).encode()).hexdigest()
+
+def auth_code(secret, nonce, node):
+    # Proves knowledge of the secret for one link without sending it; binding the
+    # sender's node id stops a challenge being reflected back to its issuer
+    return hmac.new(secret, f"{nonce}|{node}".encode(), hashlib.sha256).hexdigest()
+
+def recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(65536, size - len(data)))
+        if not chunk:
+            raise ConnectionError("peer closed the link")
+        data += chunk
+    return bytes(data)
+
+class PeerLink:
+    """One persistent, multiplexed TCP link to another node.
+
+    Control and chat frames go on a priority queue; file chunks go on a bulk
+    queue that the writer only drains when no control frame is waiting.
+    Each side opens with a hello carrying a fresh nonce and answers the
+    other's with an HMAC of it under the shared secret; until that checks
+    out, any other frame closes the link.
+    """
+
+    def __init__(self, federation, sock, outgoing):
+        self.federation = federation
+        self.sock = sock
+        self.outgoing = outgoing
+        self.node = None
+        self.nonce = os.urandom(16).hex()
+        self.authenticated = False
+        self.control = collections.deque()
+        self.bulk = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.streams = {}  # stream id -> (header, bytearray) for incoming files
+
+    def start(self):
+        threading.Thread(target=self._writer, daemon=True).start()
+        threading.Thread(target=self._reader, daemon=True).start()
+
+    def send(self, header, body=b"", bulk=False):
+        with self.cond:
+            (self.bulk if bulk else self.control).append((header, body))
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self.federation._link_closed(self)
+
+    def _writer(self):
+        try:
+            while True:
+                with self.cond:
+                    while not self.closed and not self.control and not self.bulk:
+                        self.cond.wait()
+                    if self.closed:
+                        return
+                    header, body = (self.control or self.bulk).popleft()
+                encoded = json.dumps(header).encode()
+                self.sock.sendall(FRAME.pack(len(encoded), len(body)) + encoded)
+                if body:
+                    self.sock.sendall(body)
+        except OSError:
+            self.close()
+
+    def _reader(self):
+        try:
+            while True:
+                header_len, body_len = FRAME.unpack(recv_exact(self.sock, FRAME.size))
+                header = json.loads(recv_exact(self.sock, header_len))
+                body = recv_exact(self.sock, body_len) if body_len else b""
+                self.federation._dispatch(self, header, body)
+        except OSError:
+            pass
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            # Malformed frame: e.g. a missing field or an unknown file stream
+            self.federation.log("federation", "warning", "bad_frame", peer=self.node, error=repr(e))
+        finally:
+            self.close()
+
+class Federation:
+    """Mesh of chat server nodes sharing presence and routing traffic.
+
+    Every node links directly to every other node, so a message for a remote
+    user crosses exactly one link and broadcasts go out once per link without
+    being re-forwarded. `routes` maps each remote user to the node holding them.
+
+    The server supplies callbacks:
+      local_users()               -> usernames connected to this node
+      on_frame(kind, header, body) for "broadcast", "msg" and "file" traffic
+      on_presence(joined, left)   when remote users come or go
+      on_conflict(username)       when a remote node wins a duplicate login
+    """
+
+    def __init__(self, node_id, local_users, on_frame, on_presence, on_conflict, log=None, secret=None):
+        self.node_id = node_id
+        self.secret = secret  # bytes; links are refused until one is set
+        self.local_users = local_users
+        self.on_frame = on_frame
+        self.on_presence = on_presence
+        self.on_conflict = on_conflict
+        self.log = log or (lambda *args, **fields: None)
+        self.lock = threading.Lock()
+        self.links = {}       # node id -> PeerLink
+        self.routes = {}      # username -> node id
+        self.node_users = {}  # node id -> set of usernames
+        self.next_stream = 0
+        self.listener = None  # peer listening socket, once listen() has run
+        self.digests_started = False
+        self.forward = None   # set by hand_over(); takes (sock, addr) of each accepted peer
+
+    # --- lifecycle ---------------------------------------------------------
+
+    def listen(self, host, port, sock=None):
+        # `sock` is an already listening socket inherited from a previous process
+        server = sock
+        if server is None:
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind((host, port))
+            server.listen()
+        self.listener = server
+
+        def accept_loop():
+            while True:
+                sock, addr = server.accept()
+                if self.forward:
+                    self.forward(sock, addr)
+                else:
+                    self._start_link(sock, outgoing=False)
+
+        threading.Thread(target=accept_loop, daemon=True).start()
+        self._start_digests()
+
+    def connect(self, host, port):
+        # Keep re-dialing for as long as the peer is unreachable or the link drops
+        def dial_loop():
+            while True:
+                try:
+                    sock = socket.create_connection((host, port))
+                except OSError:
+                    time.sleep(RECONNECT_INTERVAL)
+                    continue
+                link = self._start_link(sock, outgoing=True)
+                # Also wait while the peer's own link to us is the one in use
+                while not link.closed or (link.node and self.links.get(link.node)):
+                    time.sleep(RECONNECT_INTERVAL)
+
+        threading.Thread(target=dial_loop, daemon=True).start()
+        self._start_digests()
+
+    def hand_over(self, forward):
+        """Pass peer connections accepted from now on to `forward` instead of linking them.
+
+        Used by a hot restart, once the listener is shared with the new process.
+        """
+        self.forward = forward
+
+    def adopt(self, sock):
+        """Link a peer connection that a previous process accepted on our listener."""
+        self._start_link(sock, outgoing=False)
+
+    def _start_digests(self):
+        # One digest loop per node, whether it listens, dials or both
+        with self.lock:
+            if self.digests_started:
+                return
+            self.digests_started = True
+        threading.Thread(target=self._digest_loop, daemon=True).start()
+
+    def _start_link(self, sock, outgoing):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        link = PeerLink(self, sock, outgoing)
+        # Queued before the reader runs, so the hello always goes out ahead of our auth reply
+        link.send({"type": "hello", "node": self.node_id, "nonce": link.nonce})
+        link.start()
+        return link
+
+    def _register(self, link):
+        with self.lock:
+            existing = self.links.get(link.node)
+            if existing and not existing.closed:
+                # Both sides dialed: keep the link dialed by the lower node id
+                dialer = self.node_id if link.outgoing else link.node
+                if dialer != min(self.node_id, link.node):
+                    loser = link
+                else:
+                    loser, self.links[link.node] = existing, link
+            else:
+                loser, self.links[link.node] = None, link
+        if loser is link:
+            link.close()
+            return
+        if loser:
+            loser.close()
+        link.send({"type": "presence_full", "users": sorted(self.local_users())})
+        self.log("federation", "info", "link_up", peer=link.node)
+
+    def _link_closed(self, link):
+        with self.lock:
+            if link.node is None or self.links.get(link.node) is not link:
+                return
+            del self.links[link.node]
+            gone = self.node_users.pop(link.node, set())
+            for user in gone:
+                if self.routes.get(user) == link.node:
+                    del self.routes[user]
+        self.log("federation", "warning", "link_down", peer=link.node, users=len(gone))
+        if gone:
+            self.on_presence([], sorted(gone))
+
+    # --- routing -----------------------------------------------------------
+
+    def locate(self, username):
+        return self.routes.get(username)
+
+    def remote_users(self):
+        with self.lock:
+            return list(self.routes)
+
+    def _send_to(self, node, header, body=b"", bulk=False):
+        link = self.links.get(node)
+        if link is None or link.closed:
+            return False
+        link.send(header, body, bulk)
+        return True
+
+    def user_joined(self, username):
+        self._send_all({"type": "presence_delta", "joined": [username], "left": []})
+
+    def user_left(self, username):
+        self._send_all({"type": "presence_delta", "joined": [], "left": [username]})
+
+    def _send_all(self, header):
+        with self.lock:
+            links = list(self.links.values())
+        for link in links:
+            link.send(header)
+
+    def broadcast(self, sender, text):
+        self._send_all({"type": "broadcast", "from": sender, "text": text})
+
+    def send_private(self, sender, target, text, offline=False):
+        # `offline` marks a message that was spooled here while the target was away
+        node = self.locate(target)
+        header = {"type": "msg", "from": sender, "to": target, "text": text}
+        if offline:
+            header["offline"] = True
+        return node is not None and self._send_to(node, header)
+
+    def send_file(self, sender, targets, file_name, file_data):
+        """Ship one copy of a file to each node holding any of `targets`.
+
+        Returns the targets that could not be routed.
+        """
+        by_node = collections.defaultdict(list)
+        unrouted = []
+        for target in targets:
+            node = self.locate(target)
+            if node is None:
+                unrouted.append(target)
+            else:
+                by_node[node].append(target)
+        for node, node_targets in by_node.items():
+            with self.lock:
+                stream = self.next_stream
+                self.next_stream += 1
+            header = {"type": "file_start", "stream": stream, "from": sender, "to": node_targets,
+                      "name": file_name, "size": len(file_data)}
+            if not self._send_to(node, header, bulk=True):
+                unrouted.extend(node_targets)
+                continue
+            view = memoryview(file_data)
+            for offset in range(0, len(file_data), CHUNK_SIZE):
+                self._send_to(node, {"type": "file_chunk", "stream": stream}, view[offset:offset + CHUNK_SIZE], bulk=True)
+            self._send_to(node, {"type": "file_end", "stream": stream}, bulk=True)
+        return unrouted
+
+    # --- incoming frames ---------------------------------------------------
+
+    def _dispatch(self, link, header, body):
+        kind = header["type"]
+        if not link.authenticated:
+            self._authenticate(link, kind, header)
+        elif kind == "presence_full":
+            self._apply_presence(link.node, set(header["users"]), replace=True)
+        elif kind == "presence_delta":
+            self._apply_presence(link.node, set(header["joined"]), left=set(header["left"]))
+        elif kind == "presence_digest":
+            with self.lock:
+                known = presence_digest(self.node_users.get(link.node, ()))
+            if known != header["digest"]:
+                link.send({"type": "presence_request"})
+        elif kind == "presence_request":
+            link.send({"type": "presence_full", "users": sorted(self.local_users())})
+        elif kind == "file_start":
+            link.streams[header["stream"]] = (header, bytearray())
+        elif kind == "file_chunk":
+            link.streams[header["stream"]][1].extend(body)
+        elif kind == "file_end":
+            start, data = link.streams.pop(header["stream"])
+            self.on_frame("file", start, bytes(data))
+        else:
+            self.on_frame(kind, header, body)
+
+    def _authenticate(self, link, kind, header):
+        if kind == "hello" and link.node is None and self.secret:
+            node = str(header["node"])
+            if node == self.node_id:
+                raise ValueError("peer claims our own node id")
+            link.node = node
+            link.send({"type": "auth", "mac": auth_code(self.secret, header["nonce"], self.node_id)})
+        elif kind == "auth" and link.node is not None and \
+                hmac.compare_digest(str(header["mac"]), auth_code(self.secret, link.nonce, link.node)):
+            link.authenticated = True
+            self._register(link)
+        else:
+            raise ValueError(f"unauthenticated '{kind}' frame")
+
+    def _apply_presence(self, node, joined, left=(), replace=False):
+        local = set(self.local_users())
+        conflicts = []
+        with self.lock:
+            current = self.node_users.setdefault(node, set())
+            if replace:
+                left = current - joined
+                joined = joined - current
+            for user in left:
+                current.discard(user)
+                if self.routes.get(user) == node:
+                    del self.routes[user]
+            for user in list(joined):
+                # Duplicate login across nodes: the lower node id keeps the session
+                if user in local and self.node_id < node:
+                    joined.discard(user)
+                    continue
+                owner = self.routes.get(user)
+                if owner is not None and owner != node and owner < node:
+                    joined.discard(user)
+                    continue
+                if user in local:
+                    conflicts.append(user)
+                current.add(user)
+                self.routes[user] = node
+        for user in conflicts:
+            self.log("federation", "warning", "duplicate_login", user=user, winner=node)
+            self.on_conflict(user)
+        if joined or left:
+            self.on_presence(sorted(joined), sorted(left))
+
+    def _digest_loop(self):
+        while True:
+            time.sleep(DIGEST_INTERVAL)
+            self._send_all({"type": "presence_digest", "digest": presence_digest(self.local_users())})
@@ -0,0 +1,188 @@
+# file_store.py
+import hashlib
+import json
+import os
+import threading
+import time
+
+FILE_STORE_DIR = "files"
+GC_GRACE_SECONDS = 24 * 3600  # unreferenced blobs are kept this long for dedup
+COMPACT_EVERY = 1000  # reference changes journaled before refs.json is rewritten
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def is_content_hash(value):
+    return len(value) == 64 and all(c in "0123456789abcdef" for c in value)
+
+class FileStore:
+    """Content-addressed blob store keyed by SHA-256.
+
+    Blobs live at ``<root>/<hash[:2]>/<hash>``. Reference counts (one per
+    pending delivery) are kept in ``refs.json``, with changes since it was
+    written appended to the journal it names; blobs whose count has been
+    zero for longer than the grace period are removed by `gc`, so recently
+    uploaded content can still be re-sent without another upload.
+
+    A hash alone is not proof of having the content, so ``holders.json``
+    records who uploaded or received each blob, and only they may re-send
+    it without uploading.
+    """
+
+    def __init__(self, root=FILE_STORE_DIR, grace=GC_GRACE_SECONDS, clock=time.time):
+        self.root = root
+        self.grace = grace
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.refs_path = os.path.join(root, "refs.json")
+        self.holders_path = os.path.join(root, "holders.json")
+        os.makedirs(root, exist_ok=True)
+        self.holders = self._load(self.holders_path)  # digest -> [username]
+        self._load_refs()
+
+    def _path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _load(self, path):
+        if not os.path.exists(path):
+            return {}
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def _save(self, path, data):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def _journal_path(self, generation):
+        return os.path.join(self.root, f"refs.{generation}.log")
+
+    def _load_refs(self):
+        saved = self._load(self.refs_path)
+        if "refs" not in saved:
+            saved = {"journal": 0, "refs": saved}  # written before the journal existed
+        self.refs = saved["refs"]
+        self.generation = saved["journal"]
+        self.journaled = 0
+        torn = False
+        journal_path = self._journal_path(self.generation)
+        if os.path.exists(journal_path):
+            with open(journal_path, "r") as f:
+                for line in f:
+                    digest, _, delta = line.partition(" ")
+                    try:
+                        self._apply(digest, int(delta))
+                    except ValueError:
+                        torn = True  # a line cut short by a crash
+                        break
+                    self.journaled += 1
+        self.journal = open(journal_path, "a")
+        if torn:
+            # Start a clean journal rather than append after the partial line
+            self._compact_refs()
+        for name in os.listdir(self.root):
+            # Left behind by a crash during compaction
+            if name.startswith("refs.") and name.endswith(".log") and name != os.path.basename(self.journal.name):
+                os.remove(os.path.join(self.root, name))
+
+    def _apply(self, digest, delta):
+        remaining = self.refs.get(digest, 0) + delta
+        if remaining > 0:
+            self.refs[digest] = remaining
+        else:
+            self.refs.pop(digest, None)
+
+    def _change_refs(self, digest, delta):
+        # Called with self.lock held: one appended line per change instead of
+        # rewriting refs.json, which is only compacted every COMPACT_EVERY changes
+        self._apply(digest, delta)
+        self.journal.write(f"{digest} {delta}\n")
+        self.journal.flush()
+        self.journaled += 1
+        if self.journaled >= COMPACT_EVERY:
+            self._compact_refs()
+
+    def _compact_refs(self):
+        # refs.json names the journal that follows it, so a crash before the old
+        # journal is removed leaves a stale file that is never replayed
+        old_path = self._journal_path(self.generation)
+        self.generation += 1
+        self.journal.close()
+        self.journal = open(self._journal_path(self.generation), "w")
+        self._save(self.refs_path, {"journal": self.generation, "refs": self.refs})
+        self.journaled = 0
+        os.remove(old_path)
+
+    def acquire(self, digest, username):
+        """Take a reference on existing content `username` holds; False if it isn't stored or theirs."""
+        if not is_content_hash(digest):
+            return False
+        with self.lock:
+            path = self._path(digest)
+            if username not in self.holders.get(digest, ()) or not os.path.exists(path):
+                return False
+            os.utime(path)
+            self._change_refs(digest, 1)
+            return True
+
+    def add_holders(self, digest, usernames):
+        """Record that `usernames` uploaded or received the content."""
+        with self.lock:
+            holders = self.holders.setdefault(digest, [])
+            added = [user for user in usernames if user not in holders]
+            if added:
+                holders.extend(added)
+                self._save(self.holders_path, self.holders)
+
+    def size(self, digest):
+        return os.path.getsize(self._path(digest))
+
+    def put(self, data):
+        digest = content_hash(data)
+        path = self._path(digest)
+        with self.lock:
+            if os.path.exists(path):
+                # Refresh the timestamp so gc treats it as recently used
+                os.utime(path)
+                return digest
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return digest
+
+    def get(self, digest):
+        with open(self._path(digest), "rb") as f:
+            return f.read()
+
+    def incref(self, digest, count=1):
+        with self.lock:
+            self._change_refs(digest, count)
+
+    def decref(self, digest, count=1):
+        with self.lock:
+            self._change_refs(digest, -count)
+            if digest not in self.refs and os.path.exists(self._path(digest)):
+                os.utime(self._path(digest))
+
+    def gc(self):
+        """Delete unreferenced blobs older than the grace period. Returns bytes freed."""
+        freed = 0
+        cutoff = self.clock() - self.grace
+        with self.lock:
+            for prefix in os.listdir(self.root):
+                prefix_dir = os.path.join(self.root, prefix)
+                if not os.path.isdir(prefix_dir):
+                    continue
+                for digest in os.listdir(prefix_dir):
+                    path = os.path.join(prefix_dir, digest)
+                    if digest in self.refs or os.path.getmtime(path) > cutoff:
+                        continue
+                    freed += os.path.getsize(path)
+                    os.remove(path)
+                    self.holders.pop(digest, None)
+            if freed:
+                self._save(self.holders_path, self.holders)
+        return freed
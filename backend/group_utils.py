@@ -0,0 +1,128 @@
+# group_utils.py
+import os
+import re
+from cryptography.exceptions import UnsupportedAlgorithm
+from cryptography.hazmat.primitives import serialization, hashes
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+# Group traffic uses sized frames, "<tag> <field>... <size>\n" followed by
+# <size> bytes of body, so ciphertext and keys can be relayed as raw bytes.
+# Client -> server: /pubkey, /join <room>, /leave <room>,
+#                   /gkey <room> <epoch> (JSON of wrapped keys), /gmsg <room> <epoch>
+# Server -> client: [Room] <room> <epoch> (JSON of member public keys),
+#                   [GroupKey] <room> <sender> <epoch>, [Group] <room> <sender> <epoch>
+# Server frames start with FRAME_MARK. The server strips control characters,
+# the mark included, from all chat text it relays, so text can never pass for
+# the start of a frame. The hot restart notice, [Restart] <delay>, uses the
+# same framing so that no user can send a fake one.
+CLIENT_COMMANDS = (b"/pubkey ", b"/join ", b"/leave ", b"/gkey ", b"/gmsg ")
+FRAME_MARK = b"\x1e"  # ASCII record separator
+SERVER_FIELDS = {"[Room]": 3, "[GroupKey]": 4, "[Group]": 4}  # tag -> field count, tag included
+MAX_HEADER = 256
+MAX_BODY = 256 * 1024
+MAX_MESSAGE = 4000  # characters; no longer bound by RSA's 190 bytes
+RESTART_TAG = "[Restart]"
+RECONNECT_SPREAD = (0.5, 5.0)  # seconds; clients reconnect at a random point in this window
+ROOM_NAME = re.compile(r"[A-Za-z0-9_-]{1,32}")
+CONTROL_CHARS = re.compile(r"[\x00-\x1f\x7f]")
+NONCE_SIZE = 12
+
+def frame(tag, fields, body=b""):
+    header = " ".join([tag, *fields, str(len(body))]) + "\n"
+    return header.encode() + body
+
+def server_frame(tag, fields, body=b""):
+    return FRAME_MARK + frame(tag, fields, body)
+
+def clean_text(text):
+    # Newlines could fake extra lines of a server reply, and the frame mark a room frame
+    return CONTROL_CHARS.sub(" ", text)
+
+def parse_frame(data):
+    """Split a sized frame off the front of `data`.
+
+    Returns (fields, body, size, rest); `body` is short when the rest has not
+    been received yet. Returns None if `data` does not start with a frame.
+    """
+    end = data.find(b"\n", 0, MAX_HEADER)
+    if end < 0:
+        return None
+    fields = data[:end].decode(errors="replace").split(" ")
+    if len(fields) < 2 or not fields[-1].isdigit() or int(fields[-1]) > MAX_BODY:
+        return None
+    size = int(fields[-1])
+    start = end + 1
+    return fields[:-1], data[start:start + size], size, data[start + size:]
+
+def parse_server_frame(data):
+    """Like parse_frame, for a server frame at the front of `data`.
+
+    Returns None unless `data` starts with the frame mark and a known tag
+    with the right number of fields.
+    """
+    if not data.startswith(FRAME_MARK):
+        return None
+    parsed = parse_frame(data[len(FRAME_MARK):])
+    if parsed is None or SERVER_FIELDS.get(parsed[0][0]) != len(parsed[0]):
+        return None
+    return parsed
+
+def restart_frame(delay):
+    return server_frame(RESTART_TAG, [f"{delay:.2f}"])
+
+def parse_restart(data):
+    """Return the reconnect delay if `data` starts with a restart notice, else None.
+
+    The delay is clamped to the end of RECONNECT_SPREAD.
+    """
+    if not data.startswith(FRAME_MARK):
+        return None
+    parsed = parse_frame(data[len(FRAME_MARK):])
+    if parsed is None or len(parsed[0]) != 2 or parsed[0][0] != RESTART_TAG:
+        return None
+    try:
+        delay = float(parsed[0][1])
+    except ValueError:
+        return None
+    if not delay >= 0:  # negative or nan
+        return None
+    return min(delay, RECONNECT_SPREAD[1])
+
+def new_sender_key():
+    return AESGCM.generate_key(bit_length=256)
+
+def _associated_data(room, sender, epoch):
+    # Binds the ciphertext to where it was sent, so it cannot be replayed elsewhere
+    return f"{room} {sender} {epoch}".encode()
+
+def seal(key, room, sender, epoch, text):
+    nonce = os.urandom(NONCE_SIZE)
+    return nonce + AESGCM(key).encrypt(nonce, text.encode(), _associated_data(room, sender, epoch))
+
+def open_sealed(key, room, sender, epoch, data):
+    """Decrypt a group message; raises cryptography's InvalidTag if it was tampered with."""
+    nonce, ciphertext = data[:NONCE_SIZE], data[NONCE_SIZE:]
+    return AESGCM(key).decrypt(nonce, ciphertext, _associated_data(room, sender, epoch)).decode()
+
+_OAEP = padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
+
+def wrap_key(public_key, key):
+    return public_key.encrypt(key, _OAEP)
+
+def unwrap_key(private_key, data):
+    return private_key.decrypt(data, _OAEP)
+
+def public_pem(public_key):
+    return public_key.public_bytes(encoding=serialization.Encoding.PEM,
+                                   format=serialization.PublicFormat.SubjectPublicKeyInfo)
+
+def load_public_pem(pem):
+    """Parse a member's public key; raises ValueError unless it is an RSA key of 2048+ bits."""
+    try:
+        key = serialization.load_pem_public_key(pem)
+    except UnsupportedAlgorithm as e:
+        raise ValueError(str(e))
+    if not isinstance(key, rsa.RSAPublicKey) or key.key_size < 2048:
+        raise ValueError("expected an RSA key of at least 2048 bits")
+    return key
@@ -0,0 +1,107 @@
+# handoff.py
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+HANDOFF_PATH = "server.handoff"
+MAX_FDS = 8  # most descriptors accepted with a single message
+
+class Channel:
+    """Newline-delimited JSON messages over a Unix socket.
+
+    A message may carry open file descriptors (SCM_RIGHTS); its "fds" field
+    says how many, and they are handed back in the order they were sent.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = b""
+        self.fds = []
+        self.lock = threading.Lock()  # senders on several threads
+
+    def send(self, message, fds=()):
+        data = json.dumps(dict(message, fds=len(fds))).encode() + b"\n"
+        with self.lock:
+            if fds:
+                socket.send_fds(self.sock, [data], list(fds))
+            else:
+                self.sock.sendall(data)
+
+    def recv(self):
+        """Return (message, fds), or (None, []) once the other side has closed."""
+        while b"\n" not in self.buffer:
+            data, fds, _, _ = socket.recv_fds(self.sock, 65536, MAX_FDS)
+            self.fds.extend(fds)
+            if not data:
+                return None, []
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b"\n", 1)
+        message = json.loads(line)
+        fds, self.fds = self.fds[:message["fds"]], self.fds[message["fds"]:]
+        return message, fds
+
+    def close(self):
+        self.sock.close()
+
+def listen(path, on_takeover):
+    """Accept takeover requests from a newly started server on `path`.
+
+    `on_takeover(channel)` runs once, for the first request; it hands over the
+    listening sockets and owns the channel from then on.
+    """
+    # The channel carries the server's private key, so the socket must be
+    # owner-only before anyone can connect: bind it inside a fresh 0700
+    # directory, restrict it, then move it into place
+    private_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(os.path.join(private_dir, "handoff"))
+        os.chmod(os.path.join(private_dir, "handoff"), 0o600)
+        listener.listen()
+        os.replace(os.path.join(private_dir, "handoff"), path)
+    finally:
+        shutil.rmtree(private_dir, ignore_errors=True)
+
+    def accept_loop():
+        while True:
+            sock, _ = listener.accept()
+            channel = Channel(sock)
+            try:
+                message, _ = channel.recv()
+            except (OSError, ValueError):
+                message = None
+            if not message or message.get("type") != "takeover":
+                channel.close()
+                continue
+            # Only one successor: stop answering before handing anything over
+            listener.close()
+            if os.path.exists(path):
+                os.unlink(path)
+            on_takeover(channel)
+            return
+
+    threading.Thread(target=accept_loop, name="handoff", daemon=True).start()
+
+def request(path):
+    """Ask the server listening on `path` to hand over its sockets.
+
+    Returns (channel, {name: socket}, private key PEM), or None when no server
+    is listening there and this process should start from scratch.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+    channel = Channel(sock)
+    channel.send({"type": "takeover"})
+    message, fds = channel.recv()
+    if not message or message.get("type") != "sockets":
+        channel.close()
+        return None
+    sockets = {name: socket.socket(fileno=fd) for name, fd in zip(message["names"], fds)}
+    return channel, sockets, message["key"].encode()
@@ -0,0 +1,17 @@
+# metrics_utils.py
+import threading
+
+_counters = {}
+_lock = threading.Lock()
+
+def increment(name, amount=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+def get(name):
+    with _lock:
+        return _counters.get(name, 0)
+
+def snapshot():
+    with _lock:
+        return dict(_counters)
@@ -0,0 +1,95 @@
+# rate_limit_utils.py
+import threading
+import time
+
+# command -> (refill rate per second, burst capacity)
+# "any" is the per-user budget shared by every command; "file_bytes" is
+# charged chunk by chunk as an upload streams in, throttling it rather than
+# capping the file size.
+LIMITS = {
+    "any": (20.0, 40.0),
+    "msg": (5.0, 10.0),
+    "file": (0.5, 3.0),
+    "search": (1.0, 5.0),
+    "room": (1.0, 20.0),  # /pubkey, /join, /leave: each one re-sends the room's key directory
+    "file_bytes": (1024 * 1024.0, 8 * 1024 * 1024.0),
+}
+PRUNE_INTERVAL = 60.0  # seconds between sweeps for buckets that have refilled
+
+class TokenBucket:
+    # Rate and capacity live in LIMITS, so each bucket is just two floats.
+    __slots__ = ("tokens", "stamp")
+
+    def __init__(self, capacity, now):
+        self.tokens = capacity
+        self.stamp = now
+
+    def consume(self, amount, rate, capacity, now):
+        # Refill lazily from the time elapsed since the last check
+        self.tokens = min(capacity, self.tokens + (now - self.stamp) * rate)
+        self.stamp = now
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        # Seconds until enough tokens are available
+        return (amount - self.tokens) / rate
+
+    def is_full(self, rate, capacity, now):
+        return self.tokens + (now - self.stamp) * rate >= capacity
+
+class RateLimiter:
+    def __init__(self, limits=None, clock=time.monotonic):
+        self.limits = dict(LIMITS if limits is None else limits)
+        self.clock = clock
+        self.buckets = {}  # username -> {command: TokenBucket}
+        self.lock = threading.Lock()
+        self.pruned = clock()
+
+    def check(self, username, command, amount=1.0):
+        """Charge `amount` to the user's `command` bucket.
+
+        Returns 0.0 when allowed, otherwise the number of seconds to wait.
+        """
+        if amount < 0:
+            raise ValueError("amount must not be negative")
+        rate, capacity = self.limits[command]
+        if amount > capacity:
+            return float("inf")
+        now = self.clock()
+        with self.lock:
+            if now - self.pruned > PRUNE_INTERVAL:
+                self._prune(now)
+            user_buckets = self.buckets.get(username)
+            if user_buckets is None:
+                user_buckets = self.buckets[username] = {}
+            bucket = user_buckets.get(command)
+            if bucket is None:
+                bucket = user_buckets[command] = TokenBucket(capacity, now)
+            return bucket.consume(amount, rate, capacity, now)
+
+    def check_command(self, username, command, amount=1.0):
+        # Per-user budget first, then the command's own bucket
+        wait = self.check(username, "any")
+        if wait:
+            return wait
+        return self.check(username, command, amount)
+
+    def throttle(self, username, command, amount):
+        """Wait until `amount` fits in the user's `command` bucket, then charge it.
+
+        For streams charged piece by piece; `amount` must fit the capacity.
+        """
+        while True:
+            wait = self.check(username, command, amount)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def _prune(self, now):
+        # Buckets survive disconnects, so reconnecting never refills them early.
+        # A user whose buckets have all refilled is dropped: a new full bucket
+        # behaves exactly the same.
+        self.pruned = now
+        for username, user_buckets in list(self.buckets.items()):
+            if all(bucket.is_full(*self.limits[command], now) for command, bucket in user_buckets.items()):
+                del self.buckets[username]
@@ -0,0 +1,79 @@
+# rooms.py
+import itertools
+import threading
+
+MAX_PUBLIC_KEY = 1024  # bytes of PEM; a 2048-bit RSA key is about 450
+
+class Rooms:
+    """Group rooms and the public-key directory their members share.
+
+    Members register a public key once per session; joining a room requires
+    one. Every membership change gives the room a new epoch, taken from one
+    counter so an epoch is never reused, even after a room empties and is
+    created again. Clients rotate their sender keys when the epoch changes.
+    """
+
+    def __init__(self):
+        self.keys = {}     # username -> public key PEM
+        self.members = {}  # room -> set of usernames
+        self.epochs = {}   # room -> current epoch
+        self.counter = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def register(self, username, pem):
+        with self.lock:
+            self.keys[username] = bytes(pem)
+
+    def has_key(self, username):
+        return username in self.keys
+
+    def _snapshot(self, room):
+        # (epoch, {member: public key PEM}) for the room's current members
+        return self.epochs.get(room, 0), {user: self.keys[user] for user in self.members.get(room, ())}
+
+    def members_of(self, room):
+        with self.lock:
+            return list(self.members.get(room, ()))
+
+    def is_member(self, room, username, epoch=None):
+        with self.lock:
+            return username in self.members.get(room, ()) and epoch in (None, self.epochs.get(room))
+
+    def join(self, room, username):
+        """Add a member; returns the new (epoch, directory), or None if already a member."""
+        with self.lock:
+            members = self.members.setdefault(room, set())
+            if username in members:
+                return None
+            members.add(username)
+            self.epochs[room] = next(self.counter)
+            return self._snapshot(room)
+
+    def leave(self, room, username):
+        """Remove a member; returns the new (epoch, directory), or None if not a member."""
+        with self.lock:
+            members = self.members.get(room)
+            if not members or username not in members:
+                return None
+            members.discard(username)
+            if not members:
+                del self.members[room]
+                del self.epochs[room]
+                return 0, {}
+            self.epochs[room] = next(self.counter)
+            return self._snapshot(room)
+
+    def forget(self, username):
+        """Drop a disconnected user's key and memberships.
+
+        Returns [(room, epoch, directory)] for the rooms that still have members.
+        """
+        with self.lock:
+            self.keys.pop(username, None)
+            rooms = [room for room, members in self.members.items() if username in members]
+        changed = []
+        for room in rooms:
+            epoch, directory = self.leave(room, username)
+            if directory:
+                changed.append((room, epoch, directory))
+        return changed
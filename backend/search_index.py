@@ -0,0 +1,325 @@
+# search_index.py
+import array
+import bisect
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from datetime import datetime
+
+HISTORY_DIR = "history"
+SEGMENT_SIZE = 5000      # messages buffered in memory before writing a segment
+MERGE_FACTOR = 8         # merge this many same-level segments into one of the next level
+MAX_RESULTS = 20
+
+TOKEN_RE = re.compile(r"\w+")
+# Per message: timestamp, sender name id, channel name id, offset into messages.log
+META = struct.Struct("<dIIQ")
+
+def tokenize(text):
+    return set(TOKEN_RE.findall(text.lower()))
+
+def dm_channel(user_a, user_b):
+    # Usernames never contain "|"; see USERNAME in server.py
+    return "dm:" + "|".join(sorted((user_a, user_b)))
+
+def parse_query(text):
+    """Split "/search" arguments into terms and filters.
+
+    Filters: from:<user>, in:all|dm|<user>, after:<date>, before:<date>, where a
+    date is YYYY-MM-DD, YYYY-MM-DDTHH:MM or a unix timestamp.
+    """
+    query = {"terms": [], "sender": None, "channel": None, "after": None, "before": None}
+    for word in text.split():
+        key, _, value = word.partition(":")
+        if value and key == "from":
+            query["sender"] = value
+        elif value and key == "in":
+            query["channel"] = value
+        elif value and key in ("after", "before"):
+            query[key] = _parse_time(value)
+        else:
+            query["terms"].append(word)
+    return query
+
+def _parse_time(value):
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+class Segment:
+    """Immutable postings for a contiguous range of message ids.
+
+    ``<name>.terms`` maps each term to (start, count) in ``<name>.post``, a flat
+    array of uint32 message ids in ascending order.
+    """
+
+    def __init__(self, root, name, level=0):
+        self.name = name
+        self.level = level
+        self.post_path = os.path.join(root, name + ".post")
+        self.terms_path = os.path.join(root, name + ".terms")
+        with open(self.terms_path, "r") as f:
+            self.terms = json.load(f)
+        self.file = open(self.post_path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def postings(self, term):
+        entry = self.terms.get(term)
+        if entry is None:
+            return None
+        start, count = entry
+        ids = array.array("I")
+        ids.frombytes(self.map[start * 4:(start + count) * 4])
+        return ids
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def remove(self):
+        self.close()
+        os.remove(self.post_path)
+        os.remove(self.terms_path)
+
+def write_segment(root, name, postings, level=0):
+    """Write {term: ascending ids} as a segment and return it."""
+    terms = {}
+    ids = array.array("I")
+    for term in sorted(postings):
+        terms[term] = (len(ids), len(postings[term]))
+        ids.extend(postings[term])
+    with open(os.path.join(root, name + ".post"), "wb") as f:
+        ids.tofile(f)
+    with open(os.path.join(root, name + ".terms"), "w") as f:
+        json.dump(terms, f, separators=(",", ":"))
+    return Segment(root, name, level)
+
+class SearchIndex:
+    """Append-only message history with an incremental inverted index.
+
+    Messages are appended to ``messages.log`` (JSON lines) and their metadata
+    to ``meta.bin``. New messages are indexed in memory and flushed to
+    segment files every SEGMENT_SIZE messages. Like an LSM tree, every
+    MERGE_FACTOR segments of one level are merged in a background thread into
+    a single segment of the next level, so queries only touch a few files.
+    """
+
+    def __init__(self, root=HISTORY_DIR, segment_size=SEGMENT_SIZE, merge_factor=MERGE_FACTOR):
+        self.root = root
+        self.segment_size = segment_size
+        self.merge_factor = merge_factor
+        self.lock = threading.Lock()
+        self.merging = False
+        self.retired = []        # merged-away segments, removed on the next merge
+        os.makedirs(root, exist_ok=True)
+
+        self.names = []          # id -> user or channel name
+        self.name_ids = {}
+        self.timestamps = array.array("d")
+        self.senders = array.array("I")
+        self.channels = array.array("I")
+        self.offsets = array.array("Q")
+        self.memory = {}         # term -> [ids] not yet written to a segment
+        self.memory_start = 0    # first message id held only in memory
+
+        self.log_path = os.path.join(root, "messages.log")
+        self.meta_path = os.path.join(root, "meta.bin")
+        self.names_path = os.path.join(root, "names.log")
+        self.manifest_path = os.path.join(root, "manifest.json")
+        self._load()
+        self.log_file = open(self.log_path, "ab")
+        self.meta_file = open(self.meta_path, "ab")
+
+    def _load(self):
+        if os.path.exists(self.names_path):
+            with open(self.names_path, "r") as f:
+                for line in f:
+                    self._intern(line.rstrip("\n"), persist=False)
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "rb") as f:
+                data = f.read()
+            for ts, sender, channel, offset in META.iter_unpack(data[:len(data) - len(data) % META.size]):
+                self.timestamps.append(ts)
+                self.senders.append(sender)
+                self.channels.append(channel)
+                self.offsets.append(offset)
+
+        manifest = {"segments": [], "indexed": 0}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r") as f:
+                manifest = json.load(f)
+        self.segments = [Segment(self.root, name, level) for name, level in manifest["segments"]]
+        self.next_segment = max((int(name.split("_")[1]) + 1 for name, _ in manifest["segments"]), default=0)
+        self.memory_start = manifest["indexed"]
+
+        # Re-index messages written after the last flushed segment
+        if self.memory_start < len(self.offsets):
+            with open(self.log_path, "rb") as f:
+                f.seek(self.offsets[self.memory_start])
+                for message_id in range(self.memory_start, len(self.offsets)):
+                    record = json.loads(f.readline())
+                    self._index(message_id, record["text"])
+
+    def _intern(self, name, persist=True):
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            name_id = self.name_ids[name] = len(self.names)
+            self.names.append(name)
+            if persist:
+                with open(self.names_path, "a") as f:
+                    f.write(name + "\n")
+        return name_id
+
+    def _index(self, message_id, text):
+        for term in tokenize(text):
+            self.memory.setdefault(term, []).append(message_id)
+
+    def _write_manifest(self):
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"segments": [(s.name, s.level) for s in self.segments], "indexed": self.memory_start}, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def add(self, sender, channel, text, ts=None):
+        ts = time.time() if ts is None else ts
+        with self.lock:
+            message_id = len(self.offsets)
+            offset = self.log_file.tell()
+            self.log_file.write((json.dumps({"id": message_id, "ts": ts, "from": sender,
+                                             "ch": channel, "text": text}) + "\n").encode())
+            self.log_file.flush()
+            sender_id, channel_id = self._intern(sender), self._intern(channel)
+            self.meta_file.write(META.pack(ts, sender_id, channel_id, offset))
+            self.meta_file.flush()
+            self.timestamps.append(ts)
+            self.senders.append(sender_id)
+            self.channels.append(channel_id)
+            self.offsets.append(offset)
+            self._index(message_id, text)
+
+            if len(self.offsets) - self.memory_start >= self.segment_size:
+                self._flush_memory()
+        return message_id
+
+    def _flush_memory(self):
+        name = f"seg_{self.next_segment}"
+        self.next_segment += 1
+        self.segments.append(write_segment(self.root, name, self.memory))
+        self.memory = {}
+        self.memory_start = len(self.offsets)
+        self._write_manifest()
+        self._maybe_merge()
+
+    def _mergeable(self):
+        # The newest MERGE_FACTOR segments, if they all share a level
+        tail = self.segments[-self.merge_factor:]
+        if len(tail) == self.merge_factor and len({s.level for s in tail}) == 1:
+            return tail
+        return None
+
+    def _maybe_merge(self):
+        # Called with self.lock held
+        if not self.merging and self._mergeable():
+            self.merging = True
+            threading.Thread(target=self._merge, daemon=True).start()
+
+    def _merge(self):
+        while True:
+            with self.lock:
+                segments = self._mergeable()
+                if not segments:
+                    self.merging = False
+                    return
+                name = f"seg_{self.next_segment}"
+                self.next_segment += 1
+            # Segments cover ascending id ranges, so concatenating keeps postings sorted
+            merged = {}
+            for segment in segments:
+                for term in segment.terms:
+                    merged.setdefault(term, array.array("I")).extend(segment.postings(term))
+            new_segment = write_segment(self.root, name, merged, segments[0].level + 1)
+            with self.lock:
+                start = self.segments.index(segments[0])
+                self.segments[start:start + len(segments)] = [new_segment]
+                self._write_manifest()
+                # Queries may still be reading the old segments; drop the
+                # ones retired by the previous merge instead
+                retired, self.retired = self.retired, segments
+            for segment in retired:
+                segment.remove()
+
+    def _postings(self, term, segments, memory):
+        ids = array.array("I")
+        for segment in segments:
+            found = segment.postings(term)
+            if found:
+                ids.extend(found)
+        ids.extend(memory.get(term, ()))
+        return ids
+
+    def search(self, user, terms, sender=None, channel=None, after=None, before=None, limit=MAX_RESULTS):
+        """Return the newest matching messages visible to `user`, newest first.
+
+        `channel` is "all", "dm" (any of the user's DMs) or another username.
+        """
+        terms = sorted({t for term in terms for t in tokenize(term)})
+        if not terms:
+            return []
+        with self.lock:
+            segments = list(self.segments)
+            memory = {t: list(self.memory.get(t, ())) for t in terms}
+            total = len(self.offsets)
+        lists = sorted((self._postings(t, segments, memory) for t in terms), key=len)
+
+        sender_id = self.name_ids.get(sender, -1) if sender else None
+        all_id = self.name_ids.get("all", -1)
+        wanted_channel = None
+        if channel and channel not in ("all", "dm"):
+            wanted_channel = self.name_ids.get(dm_channel(user, channel), -1)
+        elif channel == "all":
+            wanted_channel = all_id
+        visible = {}  # channel id -> whether `user` may see it
+
+        results = []
+        # Walk the rarest term newest-first, probing the others by binary search
+        for message_id in reversed(lists[0]):
+            if message_id >= total:
+                continue
+            if any(_missing(ids, message_id) for ids in lists[1:]):
+                continue
+            channel_id = self.channels[message_id]
+            if wanted_channel is not None and channel_id != wanted_channel:
+                continue
+            if channel == "dm" and channel_id == all_id:
+                continue
+            if sender_id is not None and self.senders[message_id] != sender_id:
+                continue
+            ts = self.timestamps[message_id]
+            if (after is not None and ts < after) or (before is not None and ts >= before):
+                continue
+            if channel_id not in visible:
+                name = self.names[channel_id]
+                # Names with "|" are rejected at login, so a DM channel with more than
+                # two parts was written before that and cannot be attributed safely
+                participants = name[3:].split("|")
+                visible[channel_id] = name == "all" or (len(participants) == 2 and user in participants)
+            if not visible[channel_id]:
+                continue
+            results.append(message_id)
+            if len(results) >= limit:
+                break
+        return [self._read(message_id) for message_id in results]
+
+    def _read(self, message_id):
+        with open(self.log_path, "rb") as f:
+            f.seek(self.offsets[message_id])
+            return json.loads(f.readline())
+
+def _missing(ids, message_id):
+    i = bisect.bisect_left(ids, message_id)
+    return i == len(ids) or ids[i] != message_id
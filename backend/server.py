@@ -1,122 +1,217 @@
 # backend/server.py
+import argparse
+import atexit
+import contextlib
+import json
+import os
+import random
+import re
+import signal
 import socket
+import sys
 import threading
+import time
 from rsa_utils import generate_keys, decrypt_message
+from rate_limit_utils import RateLimiter
+from spool_utils import Spool
+from auth_utils import load_users
+from connection_utils import Connection, THREAD_STACK_SIZE
+from file_store import FileStore, content_hash
+from federation import Federation, PEER_PORT, SECRET_ENV
+import group_utils
+import handoff
+from rooms import Rooms, MAX_PUBLIC_KEY
+import traffic_trace
+from search_index import SearchIndex, dm_channel, parse_query
+from datetime import datetime
+import metrics_utils
+from event_log import EventLog
 from cryptography.hazmat.primitives import serialization
 
 HOST = '127.0.0.1'
 PORT = 5000
+NODE_ID = f"{HOST}:{PORT}"
+USERNAME = re.compile(r"[^\s\x00-\x1f\x7f|]{1,64}")
 
 server_private_key, server_public_key = generate_keys()
 
-with open("server_public.pem", "wb") as f:
-    f.write(server_public_key.public_bytes(
-        encoding=serialization.Encoding.PEM,
-        format=serialization.PublicFormat.SubjectPublicKeyInfo
-    ))
+def write_public_key():
+    with open("server_public.pem", "wb") as f:
+        f.write(server_public_key.public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        ))
 
-clients = {}  # username -> connection
+clients = {}  # username -> Connection
+known_users = set()  # everyone who has logged in since startup
 lock = threading.Lock()
+rate_limiter = RateLimiter()
+event_log = EventLog()
+tracer = traffic_trace.TraceRecorder()  # enabled with --trace
+file_store = FileStore()
+GC_INTERVAL = 600  # seconds between file store garbage collections
+history = SearchIndex()
+rooms = Rooms()  # end-to-end encrypted group rooms; the server only relays
+
+def release_spooled_file(entry, payload):
+    # Spooled file offers hold a file store reference until delivered or expired
+    if entry["kind"] == "file":
+        file_store.decref(payload.decode())
+
+spool = Spool(on_expire=release_spooled_file)
+SPOOL_BATCH = 50  # offline messages per send when delivering a spool
+
+# Hot restart (--handoff): the listening sockets move to the new process, which
+# accepts at once; this one tells its clients to reconnect and drains.
+listeners = {}                   # name -> listening socket handed to a successor
+handoff_channel = None           # set once this process has handed over
+draining = threading.Event()
+state_ready = threading.Event()  # clear while a predecessor still writes shared state
+state_ready.set()
+RECONNECT_SPREAD = group_utils.RECONNECT_SPREAD
+DRAIN_TIMEOUT = 60               # seconds to wait for in-flight file transfers
+
+@contextlib.contextmanager
+def transfer(conn):
+    # Marks a file moving over `conn`; draining waits for these to finish
+    with lock:
+        conn.busy += 1
+    try:
+        yield
+    finally:
+        with lock:
+            conn.busy -= 1
+
+def claim_receiver(username):
+    """Return the user's connection with a transfer counted on it, or None.
+
+    While draining, users are about to move to the new process, so their
+    files go through the spool instead.
+    """
+    with lock:
+        conn = clients.get(username)
+        if conn is None or draining.is_set():
+            return None
+        conn.busy += 1
+        return conn
+
+def send_error(conn, code, detail):
+    # Error frames are typed so clients can tell them apart from chat text:
+    # "[Error:<CODE>]: <detail>"
+    conn.sendall(f"[Error:{code}]: {detail}".encode())
 
-def handle_client(conn, addr):
+def check_rate(conn, username, command, amount=1):
+    wait = rate_limiter.check_command(username, command, amount)
+    if not wait:
+        return True
+    metrics_utils.increment("rate_limited")
+    metrics_utils.increment(f"rate_limited.{command}")
+    event_log.emit("rate_limit", "info", "limited", user=username, command=command)
+    if wait == float("inf"):
+        send_error(conn, "RATE_LIMITED", f"Request exceeds the '{command}' limit.")
+    else:
+        send_error(conn, "RATE_LIMITED", f"Too many '{command}' requests. Retry in {wait:.1f}s.")
+    return False
+
+def trace_frame(username, message):
+    if not tracer.enabled or message.startswith("/file"):
+        return  # file frames are recorded once their size is known
+    conn_id = tracer.id_of(username)
+    if message.startswith("/msg"):
+        parts = message.split(" ", 2)
+        body = parts[2] if len(parts) > 2 else ""
+        target = tracer.id_of(parts[1]) if len(parts) > 1 else 0
+        tracer.record(conn_id, traffic_trace.FRAME, traffic_trace.OP_PRIVATE, len(body.encode()), target)
+    elif message.startswith("/search"):
+        tracer.record(conn_id, traffic_trace.FRAME, traffic_trace.OP_SEARCH, len(message.encode()))
+    else:
+        tracer.record(conn_id, traffic_trace.FRAME, traffic_trace.OP_CHAT, len(message.encode()))
+
+def online_list(username):
+    # Built in its own frame so the O(users) list is not kept alive for the
+    # lifetime of every connection
+    other_users = [user for user in clients.keys() if user != username]
+    other_users += federation.remote_users()
+    if other_users:
+        return f"[Server]: Currently online: {', '.join(other_users)}"
+    return "[Server]: You're the first user online."
+
+def handle_client(sock, addr):
+    conn = Connection(sock, addr)
     username = None
     try:
         # First message must be username
-        username = conn.recv(1024).decode().strip()
+        username = conn.login(conn.recv(1024).decode().strip())
+        if not username:
+            return
+        if not USERNAME.fullmatch(username):
+            # Names appear in replies and room frames, so no spaces or control characters,
+            # and "|" separates the two participants of a DM channel in the history
+            conn.sendall("[Server]: Invalid username. Connection rejected.".encode())
+            return
         # Step 2: Check for duplicate login
         with lock:
-            if username in clients:
-                conn.sendall("[Server]: Duplicate login detected. Connection rejected.".encode())
-                conn.close()
-                print(f"[!] Rejected duplicate login for '{username}' from {addr}")
-                return
-            clients[username] = conn
-            print(f"[+] {username} ({addr}) joined the chat.")
-            
-            # Send list of currently online users (excluding the new user)
-            other_users = [user for user in clients.keys() if user != username]
-            if other_users:
-                user_list = ", ".join(other_users)
-                conn.sendall(f"[Server]: Currently online: {user_list}".encode())
-            else:
-                conn.sendall("[Server]: You're the first user online.".encode())
+            duplicate = username in clients or federation.locate(username)
+            if not duplicate:
+                clients[username] = conn
+                known_users.add(username)
+                online = online_list(username)
+        if duplicate:
+            conn.sendall("[Server]: Duplicate login detected. Connection rejected.".encode())
+            conn.close()
+            event_log.emit("connection", "warning", "duplicate_login", user=username, addr=addr)
+            return
+        event_log.emit("connection", "info", "joined", user=username, addr=addr)
+        conn.sendall(online.encode())
+        del online  # O(users); not kept alive for the lifetime of the connection
 
+        conn.conn_id = tracer.connect(username)
         # Welcome broadcast to all other users
         broadcast(f"[Server]: {username} joined the chat.", sender=username)
+        federation.user_joined(username)
+        # After a restart, wait until the old process has flushed shared state
+        state_ready.wait()
+        # Hand anything queued while offline to a separate thread
+        start_spool_delivery(username, conn)
         while True:
-            data = conn.recv(4096)
+            data = conn.recv()
             if not data:
                 break
+            if data.startswith(group_utils.CLIENT_COMMANDS) or \
+                    any(command.startswith(data) for command in group_utils.CLIENT_COMMANDS):
+                # Group traffic is already end-to-end encrypted; never decrypted here
+                handle_group_frame(conn, username, data)
+                continue
             
             # Try to decrypt first, if it fails, treat as unencrypted command
             try:
                 message = decrypt_message(data, server_private_key)
-                print(f"[DEBUG] Decrypted message from {username}: {message}")
+                encrypted = True
             except Exception as e:
                 # If decryption fails, treat as unencrypted command (like /file)
                 message = data.decode(errors="ignore")
-                print(f"[DEBUG] Unencrypted message from {username}: {message}")
+                encrypted = False
+            # Relayed text must never contain line breaks or the group frame mark
+            message = group_utils.clean_text(message)
+            # Metadata only; message contents never reach the log
+            event_log.emit("message", "debug" if encrypted else "info", "received",
+                           user=username, size=len(data), encrypted=encrypted,
+                           command=message.split(" ", 1)[0] if message.startswith("/") else None)
+            trace_frame(username, message)
 
             # Handle file transfer command
             if message.startswith("/file"):
-                # Format: /file <username> <filename>
-                parts = message.split(" ", 2)
-                if len(parts) < 3:
-                    conn.sendall("[Server]: Usage: /file <username> <filename>".encode())
-                    continue
-            
-                target_user, file_name = parts[1], parts[2]
-                if target_user not in clients:
-                    conn.sendall(f"[Server]: User '{target_user}' not found.".encode())
-                    continue
-            
-                # Notify sender to send file size and bytes
-                ready_msg = "[Server]: Ready to receive file size."
-                conn.sendall(ready_msg.encode())
-                print(f"[DEBUG] Sent ready message to {username}: {ready_msg}")
-
-                # Receive file size (fixed-length, 10-byte string)
-                size_data = conn.recv(10)
-                if not size_data:
-                    conn.sendall("[Server]: Failed to receive file size.".encode())
-                    continue
-                    
-                try:
-                    file_size = int(size_data.decode().strip())
-                    print(f"[DEBUG] Receiving file '{file_name}' of size {file_size} bytes")
-                except ValueError:
-                    conn.sendall("[Server]: Invalid file size received.".encode())
-                    continue
-            
-                # Receive actual file content
-                file_data = b''
-                while len(file_data) < file_size:
-                    remaining = file_size - len(file_data)
-                    chunk_size = min(4096, remaining)
-                    chunk = conn.recv(chunk_size)
-                    if not chunk:
-                        break
-                    file_data += chunk
-                    #print(f"[DEBUG] Received {len(file_data)}/{file_size} bytes")
-                
-                if len(file_data) != file_size:
-                    conn.sendall(f"[Server]: File transfer incomplete. Expected {file_size}, got {len(file_data)} bytes.".encode())
-                    continue
-                
-                # Send to target user
-                try:
-                    receiver = clients[target_user]
-                    receiver.sendall(f"[File]: {username} sent you a file: {file_name}".encode())
-                    # Send header with filename and size
-                    header = f"{file_name}|{file_size}".ljust(64)
-                    receiver.sendall(header.encode())
-                    receiver.sendall(file_data)
-                    conn.sendall(f"[Server]: File '{file_name}' sent successfully to {target_user}.".encode())
-                    print(f"[DEBUG] File '{file_name}' forwarded to {target_user}")
-                except Exception as e:
-                    conn.sendall(f"[Server]: Failed to send file to {target_user}: {str(e)}".encode())
-                    print(f"[ERROR] Failed to forward file to {target_user}: {e}")
-            
+                if draining.is_set():
+                    send_error(conn, "RESTARTING", "Server is restarting; send the file again after reconnecting.")
+                elif check_rate(conn, username, "file"):
+                    with transfer(conn):
+                        handle_file(conn, username, message)
+
+            elif message.startswith("/search"):
+                if check_rate(conn, username, "search"):
+                    handle_search(conn, username, message[len("/search"):])
+            elif not check_rate(conn, username, "msg"):
+                continue
             elif message.startswith("/msg"):
                 # Format: /msg <username> <message>
                 parts = message.split(" ", 2)
@@ -128,46 +223,661 @@ def handle_client(conn, addr):
             else:
                 # Regular message - broadcast to all
                 broadcast(f"[{username}]: {message}", sender=username)
+                federation.broadcast(username, message)
+                history.add(username, "all", message)
 
     except Exception as e:
-        print(f"[!] Error with {addr}: {e}")
+        event_log.emit("connection", "error", "client_error", user=username, addr=addr, error=str(e))
     finally:
         with lock:
-            if username and username in clients:
+            registered = username and clients.get(username) is conn
+            if registered:
                 del clients[username]
         conn.close()
-        if username:
-            broadcast(f"[Server]: {username} left the chat.", sender=None)
-            print(f"[-] {username} disconnected.")
+        if registered:
+            tracer.disconnect(username, conn.conn_id)
+            federation.user_left(username)
+            for room, epoch, directory in rooms.forget(username):
+                send_room_update(room, epoch, directory)
+            if not draining.is_set():
+                # Users leaving a draining server are only moving to the new one
+                broadcast(f"[Server]: {username} left the chat.", sender=None)
+            event_log.emit("connection", "info", "left", user=username)
+
+def send_to(conns, data):
+    """Send `data` to each connection, ignoring ones that have gone away.
+
+    Called without the global lock held, and posted rather than sent: a file
+    being downloaded on one connection must not hold up the others.
+    """
+    for conn in conns:
+        try:
+            conn.post(data)
+        except OSError:
+            pass
 
 def broadcast(message, sender=None):
+    data = message.encode()  # once, not per recipient
+    with lock:
+        recipients = [conn for user, conn in clients.items() if user != sender]
+    send_to(recipients, data)
+
+def handle_group_frame(conn, username, data):
+    # Format: <command> <args...> <size>\n<body>; bodies are public keys and
+    # ciphertext, relayed as they are
+    while b"\n" not in data and len(data) < group_utils.MAX_HEADER:
+        # The header was split across reads
+        chunk = conn.recv(group_utils.MAX_HEADER - len(data))
+        if not chunk:
+            return
+        data += chunk
+    parsed = group_utils.parse_frame(data)
+    if parsed is None:
+        send_error(conn, "BAD_FRAME", "Malformed group frame.")
+        return
+    fields, body, size, rest = parsed
+    if len(body) < size:
+        body += conn.recv_exact(size - len(body))
+        if len(body) < size:
+            return
+    conn.push_back(rest)
+    command, args = fields[0], fields[1:]
+    event_log.emit("message", "debug", "received", user=username, size=size, encrypted=True, command=command)
+    # Key and membership changes fan out to the whole room, as messages do
+    if not check_rate(conn, username, "msg" if command in ("/gkey", "/gmsg") else "room"):
+        return
+
+    if command == "/pubkey":
+        try:
+            # Every member parses this key; a bad one would break the whole room
+            if size > MAX_PUBLIC_KEY or not body.startswith(b"-----BEGIN PUBLIC KEY-----"):
+                raise ValueError("not a PEM public key")
+            group_utils.load_public_pem(bytes(body))
+        except ValueError:
+            send_error(conn, "BAD_KEY", "Expected a PEM RSA public key of at least 2048 bits.")
+        else:
+            rooms.register(username, body)
+        return
+    room = args[0] if args else ""
+    if not group_utils.ROOM_NAME.fullmatch(room):
+        send_error(conn, "BAD_ROOM", "Room names are 1-32 letters, digits, '_' or '-'.")
+        return
+    if command == "/join":
+        if not rooms.has_key(username):
+            send_error(conn, "NO_KEY", "Register a public key before joining a room.")
+            return
+        change = rooms.join(room, username)
+        if change:
+            send_room_update(room, *change)
+    elif command == "/leave":
+        change = rooms.leave(room, username)
+        if change:
+            conn.sendall(f"[Server]: You left room '{room}'.".encode())
+            send_room_update(room, *change)
+    elif command in ("/gkey", "/gmsg"):
+        epoch = args[1] if len(args) > 1 else ""
+        if not rooms.is_member(room, username):
+            send_error(conn, "NOT_MEMBER", f"You are not in room '{room}'.")
+        elif not epoch.isdigit() or not rooms.is_member(room, username, int(epoch)):
+            send_error(conn, "STALE_EPOCH", f"Membership of '{room}' changed; send again after the room update.")
+        elif command == "/gkey":
+            relay_sender_keys(conn, username, room, epoch, body)
+        else:
+            if tracer.enabled:
+                tracer.record(conn.conn_id, traffic_trace.FRAME, traffic_trace.OP_OTHER, size)
+            relay_group_message(username, room, epoch, body)
+    else:
+        send_error(conn, "BAD_FRAME", f"Unknown group command '{command}'.")
+
+def send_room_update(room, epoch, directory):
+    # Members learn the new epoch and each other's public keys; each one
+    # switches to a fresh sender key before its next message
+    data = group_utils.server_frame("[Room]", [room, str(epoch)],
+                             json.dumps({user: pem.decode() for user, pem in directory.items()}).encode())
+    with lock:
+        recipients = [clients[user] for user in directory if user in clients]
+    send_to(recipients, data)
+
+def relay_sender_keys(conn, sender, room, epoch, body):
+    # Body: {"member": "<base64 sender key wrapped with that member's public key>"}
+    try:
+        envelopes = json.loads(body)
+    except ValueError:
+        envelopes = None
+    if not isinstance(envelopes, dict):
+        send_error(conn, "BAD_FRAME", "Malformed sender key frame.")
+        return
+    members = rooms.members_of(room)
+    with lock:
+        recipients = [(clients[user], wrapped) for user, wrapped in envelopes.items()
+                      if user in clients and user in members and user != sender]
+    for member, wrapped in recipients:
+        send_to([member], group_utils.server_frame("[GroupKey]", [room, sender, epoch], str(wrapped).encode()))
+
+def relay_group_message(sender, room, epoch, ciphertext):
+    # Built once; every member is sent the same bytes object
+    data = group_utils.server_frame("[Group]", [room, sender, epoch], ciphertext)
+    members = rooms.members_of(room)
     with lock:
-        for user, client_conn in clients.items():
-            if user != sender:
-                try:
-                    client_conn.sendall(message.encode())
-                except:
-                    pass
+        recipients = [clients[user] for user in members if user in clients and user != sender]
+    send_to(recipients, data)
+    metrics_utils.increment("group.relayed", len(members) - 1)
 
 def send_private_message(from_user, to_user, message):
     with lock:
-        if to_user in clients:
-            try:
-                clients[to_user].sendall(f"[Private] {from_user}: {message}".encode())
-            except:
-                pass
+        receiver = clients.get(to_user)
+        sender_conn = clients.get(from_user)
+    if receiver:
+        send_to([receiver], f"[Private] {from_user}: {message}".encode())
+    if receiver or federation.send_private(from_user, to_user, message):
+        history.add(from_user, dm_channel(from_user, to_user), message)
+        return
+
+    # Spool outside the lock so disk I/O never holds up other users
+    if not is_registered(to_user):
+        reply = f"[Server]: User '{to_user}' not found."
+    elif spool.append(to_user, "msg", from_user, message.encode()):
+        reply = f"[Server]: {to_user} is offline. Message queued for delivery."
+        history.add(from_user, dm_channel(from_user, to_user), message)
+        deliver_if_online(to_user)
+    else:
+        reply = f"[Server]: {to_user}'s offline queue is full."
+    if sender_conn:
+        try:
+            sender_conn.sendall(reply.encode())
+        except:
+            pass
+
+def handle_search(conn, username, args):
+    # Format: /search [from:<user>] [in:all|dm|<user>] [after:<date>] [before:<date>] <words>
+    try:
+        query = parse_query(args)
+    except ValueError:
+        conn.sendall("[Server]: Invalid date in search filter.".encode())
+        return
+    if not query["terms"]:
+        conn.sendall("[Server]: Usage: /search [from:user] [in:all|dm|user] [after:date] [before:date] <words>".encode())
+        return
+    results = history.search(username, query["terms"], sender=query["sender"], channel=query["channel"],
+                             after=query["after"], before=query["before"])
+    if not results:
+        conn.sendall("[Server]: No matching messages.".encode())
+        return
+    lines = [f"[Server]: {len(results)} result(s), newest first:"]
+    for record in results:
+        when = datetime.fromtimestamp(record["ts"]).strftime("%Y-%m-%d %H:%M")
+        where = "all" if record["ch"] == "all" else "DM " + " & ".join(record["ch"][3:].split("|"))
+        lines.append(f"[Search] {when} ({where}) {record['from']}: {group_utils.clean_text(record['text'])}")
+    conn.sendall("\n".join(lines).encode())
+
+def resolve_targets(username, spec):
+    """Return (targets, error) for a "/file" recipient list: "*" or user[,user...]."""
+    if spec == "*":
+        with lock:
+            targets = [user for user in clients if user != username]
+        targets += federation.remote_users()
+        if not targets:
+            return None, "[Server]: No other users online."
+        return targets, None
+    targets = list(dict.fromkeys(name for name in spec.split(",") if name))
+    for target in targets:
+        if target not in clients and not federation.locate(target) and not is_registered(target):
+            return None, f"[Server]: User '{target}' not found."
+    return targets, None
+
+def handle_file(conn, username, message):
+    # Format: /file <user>[,<user>...|*] [sha256:<hash>] <filename>
+    parts = message.split(" ", 3)
+    if len(parts) < 3:
+        conn.sendall("[Server]: Usage: /file <username>[,<username>...|*] [sha256:<hash>] <filename>".encode())
+        return
+    digest = None
+    if len(parts) == 4 and parts[2].startswith("sha256:"):
+        digest, file_name = parts[2][len("sha256:"):].lower(), parts[3]
+    else:
+        file_name = " ".join(parts[2:])
+
+    targets, error = resolve_targets(username, parts[1])
+    if error:
+        conn.sendall(error.encode())
+        return
+    full = full_queue(targets, 64)
+    if full:
+        conn.sendall(f"[Server]: {full}'s offline queue is full.".encode())
+        return
+
+    if digest and file_store.acquire(digest, username):
+        # Content this user already uploaded or received: skip the upload entirely
+        file_size = file_store.size(digest)
+        full = full_queue(targets, file_size)
+        if full:
+            file_store.decref(digest)
+            conn.sendall(f"[Server]: {full}'s offline queue is full.".encode())
+            return
+        conn.sendall("[Server]: File already stored, upload skipped.".encode())
+        metrics_utils.increment("files.upload_bytes_saved", file_size)
+    else:
+        # Notify sender to send file size and bytes
+        conn.sendall("[Server]: Ready to receive file size.".encode())
+
+        # Receive file size (fixed-length, 10-byte string)
+        size_data = conn.recv(10)
+        if not size_data:
+            conn.sendall("[Server]: Failed to receive file size.".encode())
+            return
+        try:
+            file_size = int(size_data.decode().strip())
+        except ValueError:
+            file_size = -1
+        if file_size < 0:
+            conn.sendall("[Server]: Invalid file size received.".encode())
+            return
+        event_log.emit("file", "debug", "receiving", user=username, size=file_size)
+
+        # The byte budget is charged as the upload streams in: a large file is
+        # slowed to the "file_bytes" rate rather than refused
+        file_data = conn.recv_exact(file_size, on_chunk=lambda count: rate_limiter.throttle(username, "file_bytes", count))
+        if len(file_data) != file_size:
+            conn.sendall(f"[Server]: File transfer incomplete. Expected {file_size}, got {len(file_data)} bytes.".encode())
+            return
+        if digest and content_hash(file_data) != digest:
+            conn.sendall("[Server]: File content does not match its hash.".encode())
+            return
+        # The size is only known now; the client streams the bytes right after it
+        full = full_queue(targets, file_size)
+        if full:
+            conn.sendall(f"[Server]: {full}'s offline queue is full.".encode())
+            return
+        digest = file_store.put(file_data)
+        file_store.incref(digest)
+        file_store.add_holders(digest, [username])
+        metrics_utils.increment("files.upload_bytes", file_size)
+
+    tracer.record(tracer.id_of(username), traffic_trace.FRAME, traffic_trace.OP_FILE, file_size, len(targets))
+    try:
+        sent, queued, failed = deliver_file(username, targets, file_name, digest)
+    finally:
+        file_store.decref(digest)
+
+    replies = []
+    if sent:
+        replies.append(f"[Server]: File '{file_name}' sent successfully to {', '.join(sent)}.")
+    if queued:
+        replies.append(f"[Server]: {', '.join(queued)} offline. File '{file_name}' queued for delivery.")
+    if failed:
+        replies.append(f"[Server]: Failed to send file '{file_name}' to {', '.join(failed)}.")
+    conn.sendall("\n".join(replies).encode())
+
+def deliver_file(username, targets, file_name, digest, forward=True):
+    """Fan one stored copy out to every recipient. Returns (sent, queued, failed).
+
+    Offline recipients get a reference in their spool; with `forward`, users on
+    other nodes get one copy per node over the federation.
+    """
+    file_data = file_store.get(digest)
+    sent, queued, failed, remote = [], [], [], []
+    received = []  # local recipients, who may re-send the content without uploading
+    for target in targets:
+        receiver = claim_receiver(target)
+        if receiver is None:
+            if forward and federation.locate(target):
+                remote.append(target)
+            elif queue_file(target, username, file_name, digest):
+                queued.append(target)
+            else:
+                failed.append(target)
+            continue
+        try:
+            send_file(receiver, username, file_name, file_data)
+            sent.append(target)
+            received.append(target)
+        except Exception as e:
+            failed.append(target)
+            event_log.emit("file", "error", "forward_failed", user=username, to=target, error=str(e))
+        finally:
+            with lock:
+                receiver.busy -= 1
+    if received:
+        file_store.add_holders(digest, received)
+    if remote:
+        unrouted = federation.send_file(username, remote, file_name, file_data)
+        sent.extend(target for target in remote if target not in unrouted)
+        for target in unrouted:
+            (queued if queue_file(target, username, file_name, digest) else failed).append(target)
+    metrics_utils.increment("files.deliveries", len(sent))
+    event_log.emit("file", "info", "forwarded", user=username, sent=len(sent), queued=len(queued),
+                   failed=len(failed), size=len(file_data))
+    return sent, queued, failed
+
+def full_queue(targets, size):
+    """Return the first offline target whose spool cannot take `size` more bytes."""
+    for target in targets:
+        if target not in clients and not federation.locate(target) and not spool.has_room(target, size):
+            return target
+    return None
+
+def queue_file(target, username, file_name, digest):
+    file_store.incref(digest)
+    # The spooled hash keeps the content alive, so its size counts against the quota
+    if spool.append(target, "file", username, digest.encode(), name=file_name, blob=file_store.size(digest)):
+        deliver_if_online(target)
+        return True
+    file_store.decref(digest)
+    return False
+
+def send_file(receiver, from_user, file_name, file_data):
+    # Send header with filename and size; no other frame may come in between
+    header = f"{file_name}|{len(file_data)}".ljust(64)
+    receiver.sendall(f"[File]: {from_user} sent you a file: {file_name}".encode(), header.encode(), file_data)
+
+def is_registered(username):
+    # Offline delivery is only offered to users the server knows about
+    return username in known_users or username in load_users()
+
+def deliver_spool(username, conn):
+    pending = spool.take(username)
+    if not pending:
+        return
+    messages = [(e, p) for e, p in pending if e["kind"] == "msg"]
+    files = [(e, p) for e, p in pending if e["kind"] == "file"]
+    delivered = 0
+    try:
+        # Private messages go out in a few bulk writes rather than one per message
+        for i in range(0, len(messages), SPOOL_BATCH):
+            batch = messages[i:i + SPOOL_BATCH]
+            lines = [f"[Private] {e['from']} (while you were offline): {group_utils.clean_text(p.decode())}"
+                     for e, p in batch]
+            conn.sendall("\n".join(lines).encode())
+            delivered += len(batch)
+        for entry, payload in files:
+            digest = payload.decode()
+            with transfer(conn):
+                send_file(conn, entry["from"], entry["name"], file_store.get(digest))
+            file_store.add_holders(digest, [username])
+            delivered += 1
+            file_store.decref(digest)
+        event_log.emit("spool", "info", "delivered", user=username, count=delivered)
+    except Exception as e:
+        # Connection dropped mid-delivery: put the rest back for next login
+        for entry, payload in (messages + files)[delivered:]:
+            spool.append(username, entry["kind"], entry["from"], payload,
+                         name=entry["name"], ts=entry["ts"], blob=entry.get("blob", 0))
+        event_log.emit("spool", "error", "delivery_interrupted", user=username, delivered=delivered, error=str(e))
+
+def start_spool_delivery(username, conn):
+    threading.Thread(target=deliver_spool, args=(username, conn), daemon=True).start()
+
+def deliver_if_online(username):
+    # Covers a login that raced with the spool append
+    with lock:
+        conn = clients.get(username)
+    # A draining server leaves delivery to the process the user reconnects to
+    if conn and not draining.is_set():
+        start_spool_delivery(username, conn)
+
+def deliver_remote(kind, header, body):
+    # Traffic routed here by another node; deliver locally and never re-forward
+    for field in ("text", "name"):
+        if field in header:
+            header[field] = group_utils.clean_text(str(header[field]))
+    if kind == "broadcast":
+        broadcast(f"[{header['from']}]: {header['text']}", sender=None)
+        history.add(header["from"], "all", header["text"])
+    elif kind == "msg":
+        from_user, to_user, text = header["from"], header["to"], header["text"]
+        note = " (while you were offline)" if header.get("offline") else ""
+        with lock:
+            receiver = clients.get(to_user)
+        if receiver:
+            send_to([receiver], f"[Private] {from_user}{note}: {text}".encode())
         else:
-            if from_user in clients:
-                clients[from_user].sendall(f"[Server]: User '{to_user}' not found.".encode())
-
-# Start server
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server_socket.bind((HOST, PORT))
-server_socket.listen()
-print(f"[Server] Listening on {HOST}:{PORT}")
-
-while True:
-    conn, addr = server_socket.accept()
-    thread = threading.Thread(target=handle_client, args=(conn, addr))
-    thread.start()
-    print(f"[Server] Active connections: {threading.active_count() - 1}")
\ No newline at end of file
+            spool.append(to_user, "msg", from_user, text.encode())
+            deliver_if_online(to_user)
+        history.add(from_user, dm_channel(from_user, to_user), text)
+    elif kind == "file":
+        # Slow receivers must not stall the peer link's reader
+        threading.Thread(target=deliver_remote_file, args=(header, body), daemon=True).start()
+
+def deliver_remote_file(header, body):
+    digest = file_store.put(body)
+    file_store.incref(digest)
+    try:
+        deliver_file(header["from"], header["to"], header["name"], digest, forward=False)
+    finally:
+        file_store.decref(digest)
+
+def announce_presence(joined, left):
+    known_users.update(joined)
+    for user in joined:
+        broadcast(f"[Server]: {user} joined the chat.", sender=None)
+    if joined:
+        # Disk reads and file uploads must not stall the peer link's reader
+        threading.Thread(target=forward_spools, args=(joined,), daemon=True).start()
+    for user in left:
+        broadcast(f"[Server]: {user} left the chat.", sender=None)
+
+def forward_spools(usernames):
+    """Send what was queued here to users who logged in on another node."""
+    state_ready.wait()
+    for username in usernames:
+        pending = spool.take(username)
+        forwarded = 0
+        for entry, payload in pending:
+            if entry["kind"] == "msg":
+                routed = federation.send_private(entry["from"], username, payload.decode(), offline=True)
+            else:
+                digest = payload.decode()
+                routed = not federation.send_file(entry["from"], [username], entry["name"], file_store.get(digest))
+                if routed:
+                    file_store.decref(digest)
+            if routed:
+                forwarded += 1
+            else:
+                # Left again before it went out: keep it for their next login
+                spool.append(username, entry["kind"], entry["from"], payload, name=entry["name"], ts=entry["ts"],
+                             blob=entry.get("blob", 0))
+        if pending:
+            event_log.emit("spool", "info", "forwarded", user=username, node=federation.locate(username),
+                           count=forwarded)
+
+def drop_duplicate(username):
+    # Another node won a simultaneous login for this user
+    with lock:
+        conn = clients.get(username)
+    if conn:
+        try:
+            conn.sendall("[Server]: Duplicate login detected. Connection rejected.".encode())
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+federation = Federation(NODE_ID, local_users=lambda: list(clients), on_frame=deliver_remote,
+                        on_presence=announce_presence, on_conflict=drop_duplicate, log=event_log.emit)
+
+def hand_over(channel):
+    # A new process asked for our sockets (see handoff.py)
+    global handoff_channel
+    draining.set()
+    names = list(listeners)
+    key = server_private_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption()
+    ).decode()
+    channel.send({"type": "sockets", "names": names, "key": key}, [listeners[name].fileno() for name in names])
+    handoff_channel = channel
+    # Our accept loops keep running on the shared sockets; pass what they accept on
+    federation.hand_over(lambda sock, addr: forward_connection("peer_connection", sock, addr))
+    event_log.emit("restart", "info", "handed_over", clients=len(clients))
+    threading.Thread(target=drain, args=(channel,), daemon=True).start()
+
+def drain(channel):
+    """Move clients to the new process, wait for file transfers, then exit.
+
+    Each client is told to reconnect after its own random delay so they do
+    not all arrive at once. Clients in the middle of a transfer are told once
+    it finishes.
+    """
+    notified = set()
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    grace = time.monotonic() + RECONNECT_SPREAD[1]
+    while time.monotonic() < deadline:
+        with lock:
+            ready = [conn for conn in clients.values() if not conn.busy and conn not in notified]
+            busy = sum(1 for conn in clients.values() if conn.busy)
+            remaining = len(clients)
+        for conn in ready:
+            delay = random.uniform(*RECONNECT_SPREAD)
+            send_to([conn], group_utils.restart_frame(delay))
+            notified.add(conn)
+            grace = time.monotonic() + RECONNECT_SPREAD[1]
+        if not remaining or (not busy and time.monotonic() > grace):
+            break
+        time.sleep(0.1)
+
+    # Clients that ignored the notice are disconnected
+    with lock:
+        leftover = list(clients.values())
+    for conn in leftover:
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    event_log.emit("restart", "info", "drained", busy=busy, disconnected=len(leftover))
+    try:
+        channel.send({"type": "drained"})
+    except OSError:
+        pass
+    # Exit through the SIGTERM handler so atexit flushes the logs. The channel
+    # stays open until then for connections accepted in the meantime.
+    os.kill(os.getpid(), signal.SIGTERM)
+
+def adopt_key(pem):
+    # Keep the predecessor's key so clients' cached public key stays valid
+    global server_private_key, server_public_key
+    server_private_key = serialization.load_pem_private_key(pem, password=None)
+    server_public_key = server_private_key.public_key()
+
+def reload_state():
+    # The predecessor wrote to these until it drained; start from what is on disk
+    global file_store, history
+    file_store = FileStore()
+    history = SearchIndex()
+
+def take_over_state(handoff_path):
+    reload_state()
+    state_ready.set()
+    event_log.emit("restart", "info", "took_over")
+    handoff.listen(handoff_path, hand_over)
+
+def follow_predecessor(channel, handoff_path):
+    """Serve connections the old process accepted late; take over state once it drains."""
+    while True:
+        try:
+            message, fds = channel.recv()
+        except (OSError, ValueError):
+            message = None
+        if message is None:
+            break  # the old process has exited
+        if message["type"] == "connection":
+            sock = socket.socket(fileno=fds[0])
+            threading.Thread(target=handle_client, args=(sock, tuple(message["addr"])), daemon=True).start()
+        elif message["type"] == "peer_connection":
+            federation.adopt(socket.socket(fileno=fds[0]))
+        elif message["type"] == "drained":
+            take_over_state(handoff_path)
+    channel.close()
+    if not state_ready.is_set():
+        # It exited without draining (crashed or killed)
+        take_over_state(handoff_path)
+
+def collect_garbage():
+    while True:
+        time.sleep(GC_INTERVAL)
+        freed = file_store.gc()
+        if freed:
+            event_log.emit("file", "info", "gc", freed=freed)
+
+def main():
+    parser = argparse.ArgumentParser(description="Encrypted multi-client chat server")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--node-id", help="unique name of this node in a federation (default host:port)")
+    parser.add_argument("--peer-port", type=int, help=f"accept links from other nodes on this port (e.g. {PEER_PORT})")
+    parser.add_argument("--peers", default="", help="comma-separated host:port peer addresses to link to "
+                                                      f"(both need the shared secret in ${SECRET_ENV})")
+    parser.add_argument("--trace", help="record connection and frame metadata (no message text) to this file")
+    parser.add_argument("--handoff", metavar="PATH",
+                        help=f"Unix socket for hot restarts (e.g. {handoff.HANDOFF_PATH}); "
+                             "if a server already listens there, take over from it")
+    args = parser.parse_args()
+    # Handler threads only need a small stack; set before any thread starts
+    threading.stack_size(THREAD_STACK_SIZE)
+
+    takeover = handoff.request(args.handoff) if args.handoff else None
+    inherited = {}
+    if takeover:
+        # Hot restart: the old server's listening sockets never close, so no
+        # connection is refused while we start up
+        channel, inherited, key = takeover
+        adopt_key(key)
+        write_public_key()
+        server_socket = inherited["clients"]
+        state_ready.clear()
+        threading.Thread(target=follow_predecessor, args=(channel, args.handoff), daemon=True).start()
+    else:
+        write_public_key()
+        # Start server
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Allow quick restarts while old connections sit in TIME_WAIT
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind((args.host, args.port))
+        server_socket.listen()
+        if args.handoff:
+            handoff.listen(args.handoff, hand_over)
+    listeners["clients"] = server_socket
+
+    event_log.start()
+    threading.Thread(target=collect_garbage, daemon=True).start()
+    atexit.register(event_log.close)
+    # Exit through atexit on SIGTERM so the event log and trace are flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if args.trace:
+        tracer.open(args.trace)
+        atexit.register(tracer.flush)
+
+    federation.node_id = args.node_id or f"{args.host}:{args.port}"
+    if args.peer_port or args.peers:
+        secret = os.environ.get(SECRET_ENV)
+        if not secret:
+            parser.error(f"federation needs a shared secret in ${SECRET_ENV}")
+        federation.secret = secret.encode()
+    if args.peer_port:
+        federation.listen(args.host, args.peer_port, sock=inherited.get("peers"))
+        listeners["peers"] = federation.listener
+    for peer in filter(None, args.peers.split(",")):
+        peer_host, peer_port = peer.rsplit(":", 1)
+        federation.connect(peer_host, int(peer_port))
+    print(f"[Server] Listening on {args.host}:{args.port} (events logged to {event_log.path})")
+    serve(server_socket)
+
+def serve(server_socket):
+    while True:
+        conn, addr = server_socket.accept()
+        if handoff_channel:
+            # Accepted after handing over: the new process serves it
+            forward_connection("connection", conn, addr)
+            continue
+        thread = threading.Thread(target=handle_client, args=(conn, addr), daemon=True)
+        thread.start()
+        event_log.emit("connection", "debug", "accepted", addr=addr, threads=threading.active_count() - 1)
+
+def forward_connection(kind, conn, addr):
+    try:
+        handoff_channel.send({"type": kind, "addr": list(addr)}, [conn.fileno()])
+    except OSError:
+        pass
+    conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+# spool_utils.py
+import json
+import os
+import shutil
+import threading
+import time
+
+SPOOL_DIR = "spool"
+MAX_ENTRIES = 200                 # per user
+MAX_BYTES = 20 * 1024 * 1024      # per user, message text + queued files' content
+EXPIRY_SECONDS = 7 * 24 * 3600
+
+class Spool:
+    """Bounded per-user store of private messages and file offers for offline users.
+
+    Each user gets a directory holding an append-only ``data.log`` with the raw
+    payloads and an append-only ``index.log`` with one JSON line per entry.
+    A file offer's payload is only a file store hash, so its entry also
+    records the size of the stored content (``blob``), which counts against
+    the byte quota.
+    """
+
+    def __init__(self, root=SPOOL_DIR, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES,
+                 expiry=EXPIRY_SECONDS, clock=time.time, on_expire=None):
+        self.root = root
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.expiry = expiry
+        self.clock = clock
+        self.on_expire = on_expire  # called with (entry, payload) for each expired entry
+        self.locks = {}  # username -> lock guarding that user's spool files
+        self.locks_lock = threading.Lock()
+
+    def _user_lock(self, username):
+        with self.locks_lock:
+            user_lock = self.locks.get(username)
+            if user_lock is None:
+                user_lock = self.locks[username] = threading.Lock()
+            return user_lock
+
+    def _user_dir(self, username):
+        # Hex keeps arbitrary usernames from escaping the spool directory
+        return os.path.join(self.root, username.encode().hex())
+
+    def _read_index(self, user_dir):
+        index_path = os.path.join(user_dir, "index.log")
+        if not os.path.exists(index_path):
+            return []
+        with open(index_path, "r") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def _compact(self, user_dir, entries):
+        # Rewrite the log keeping only unexpired entries
+        now = self.clock()
+        live = [e for e in entries if now - e["ts"] < self.expiry]
+        if len(live) == len(entries):
+            return entries
+        data_path = os.path.join(user_dir, "data.log")
+        tmp_data = data_path + ".tmp"
+        tmp_index = os.path.join(user_dir, "index.log.tmp")
+        with open(data_path, "rb") as src, open(tmp_data, "wb") as dst, open(tmp_index, "w") as idx:
+            if self.on_expire:
+                for entry in entries:
+                    if now - entry["ts"] >= self.expiry:
+                        src.seek(entry["offset"])
+                        self.on_expire(entry, src.read(entry["size"]))
+            for entry in live:
+                src.seek(entry["offset"])
+                payload = src.read(entry["size"])
+                entry["offset"] = dst.tell()
+                dst.write(payload)
+                idx.write(json.dumps(entry) + "\n")
+        os.replace(tmp_data, data_path)
+        os.replace(tmp_index, os.path.join(user_dir, "index.log"))
+        return live
+
+    def _used(self, entries):
+        return sum(e["size"] + e.get("blob", 0) for e in entries)
+
+    def has_room(self, username, size):
+        with self._user_lock(username):
+            user_dir = self._user_dir(username)
+            entries = self._read_index(user_dir)
+            if entries:
+                entries = self._compact(user_dir, entries)
+            return len(entries) < self.max_entries and self._used(entries) + size <= self.max_bytes
+
+    def append(self, username, kind, sender, payload, name=None, ts=None, blob=0):
+        """Queue a "msg" or "file" entry. Returns False when over quota.
+
+        `blob` is the size of the file store content a "file" entry refers to.
+        """
+        with self._user_lock(username):
+            user_dir = self._user_dir(username)
+            os.makedirs(user_dir, exist_ok=True)
+            entries = self._read_index(user_dir)
+            if entries:
+                entries = self._compact(user_dir, entries)
+            if len(entries) >= self.max_entries or self._used(entries) + len(payload) + blob > self.max_bytes:
+                return False
+
+            with open(os.path.join(user_dir, "data.log"), "ab") as f:
+                offset = f.tell()
+                f.write(payload)
+            entry = {"kind": kind, "from": sender, "name": name,
+                     "ts": self.clock() if ts is None else ts,
+                     "offset": offset, "size": len(payload)}
+            if blob:
+                entry["blob"] = blob
+            with open(os.path.join(user_dir, "index.log"), "a") as f:
+                f.write(json.dumps(entry) + "\n")
+            return True
+
+    def take(self, username):
+        """Remove and return the user's unexpired entries as (entry, payload) pairs."""
+        with self._user_lock(username):
+            user_dir = self._user_dir(username)
+            entries = self._read_index(user_dir)
+            if not entries:
+                return []
+            now = self.clock()
+            pending = []
+            with open(os.path.join(user_dir, "data.log"), "rb") as f:
+                for entry in entries:
+                    f.seek(entry["offset"])
+                    payload = f.read(entry["size"])
+                    if now - entry["ts"] >= self.expiry:
+                        if self.on_expire:
+                            self.on_expire(entry, payload)
+                        continue
+                    pending.append((entry, payload))
+            shutil.rmtree(user_dir, ignore_errors=True)
+            return pending
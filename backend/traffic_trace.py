@@ -0,0 +1,99 @@
+# traffic_trace.py
+import collections
+import struct
+import threading
+import time
+
+MAGIC = b"CHTRACE1"
+HEADER = struct.Struct("<8sd")       # magic, wall-clock start time
+# seconds since start, connection id, event, opcode, size, argument
+RECORD = struct.Struct("<dIBBII")
+
+# Events
+CONNECT, DISCONNECT, FRAME = 1, 2, 3
+
+# Opcodes for FRAME events. `size` is the plaintext length for chat and
+# private messages and the payload size for files; `arg` is the target's
+# connection id for private messages and the recipient count for files.
+OP_OTHER, OP_CHAT, OP_PRIVATE, OP_FILE, OP_SEARCH = 0, 1, 2, 3, 4
+OPCODE_NAMES = {OP_OTHER: "other", OP_CHAT: "chat", OP_PRIVATE: "private", OP_FILE: "file", OP_SEARCH: "search"}
+
+FLUSH_INTERVAL = 0.2
+
+class TraceRecorder:
+    """Opt-in recorder of connection events and frame metadata.
+
+    Records never contain usernames or message text, only connection ids,
+    opcodes, sizes and timing. Like the event log, `record` just appends to a
+    deque and a background thread writes the file; with no path it is a no-op.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.start = time.monotonic()
+        self.buffer = collections.deque()
+        self.ids = {}  # username -> connection id of their current session
+        self.next_id = 1
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def open(self, path):
+        self.path = path
+        self.start = time.monotonic()
+        with open(path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, time.time()))
+        threading.Thread(target=self._run, name="trace-writer", daemon=True).start()
+
+    def connect(self, username):
+        if not self.enabled:
+            return 0
+        with self.lock:
+            conn_id = self.ids[username] = self.next_id
+            self.next_id += 1
+        self.record(conn_id, CONNECT)
+        return conn_id
+
+    def disconnect(self, username, conn_id):
+        if not self.enabled:
+            return
+        with self.lock:
+            if self.ids.get(username) == conn_id:
+                del self.ids[username]
+        self.record(conn_id, DISCONNECT)
+
+    def id_of(self, username):
+        return self.ids.get(username, 0)
+
+    def record(self, conn_id, event, opcode=OP_OTHER, size=0, arg=0):
+        if self.enabled:
+            self.buffer.append(RECORD.pack(time.monotonic() - self.start, conn_id, event, opcode, size, arg))
+
+    def _run(self):
+        while True:
+            self.flush()
+            time.sleep(FLUSH_INTERVAL)
+
+    def flush(self):
+        chunks = []
+        try:
+            while True:
+                chunks.append(self.buffer.popleft())
+        except IndexError:
+            pass
+        if chunks:
+            with open(self.path, "ab") as f:
+                f.write(b"".join(chunks))
+
+def read_trace(path):
+    """Return (start_time, [(ts, conn_id, event, opcode, size, arg), ...])."""
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, start = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a chat traffic trace")
+    body = data[HEADER.size:]
+    body = body[:len(body) - len(body) % RECORD.size]
+    return start, list(RECORD.iter_unpack(body))
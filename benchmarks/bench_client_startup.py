@@ -0,0 +1,235 @@
+# bench_client_startup.py - client cold start: imports, first interaction, ready
+#
+# Each run starts a client in a fresh interpreter and measures:
+#   imports      time spent importing modules before the client takes input
+#                (python -X importtime), and whether cryptography was one of them;
+#                profiled against a closed port so the background connect fails
+#                fast and its own imports do not mix into the profile
+#   interactive  process start until the client accepts input: the CLI's login
+#                prompt, or the GUI's login window once its main loop is idle
+#   ready        credentials entered until the server's first reply (the online
+#                list) arrives; credentials are entered --think seconds after the
+#                client became interactive, as a person would (0 for worst case)
+# The GUI needs a display; without one only its import time is measured.
+# The server runs in a temporary directory laid out like the repo (backend/ and
+# client/ side by side) so the clients find its key at ../backend/. Medians
+# over the runs are checked against budgets; exits non-zero if one is exceeded.
+#
+# Usage: python benchmarks/bench_client_startup.py [--runs N] [--think S] [--port P]
+import argparse
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(ROOT)
+from backend.auth_utils import hash_password
+
+HOST = '127.0.0.1'
+SERVER = os.path.join(ROOT, 'backend', 'server.py')
+CLI = os.path.join(ROOT, 'client', 'cli_client.py')
+PASSWORD = "bench-password"
+# Budgets in milliseconds; raise them deliberately, not to make a run pass
+BUDGETS = {"imports": 80, "interactive": 150, "ready": 50}
+
+# Runs the GUI client and reports when it is interactive and when it is ready
+GUI_DRIVER = """
+import sys
+sys.path.insert(0, {client_dir!r})
+import gui_client
+port, username, think = int(sys.argv[1]), sys.argv[2], float(sys.argv[3])
+root = gui_client.tk.Tk()
+app = gui_client.ChatGUI(root, port)
+
+def watch(handler):
+    # The online list is shown by one handler or the other, depending on who is online
+    def wrapper(message):
+        handler(message)
+        if message.startswith("[Server]:"):
+            print("#ready#", flush=True)
+            root.after(0, root.destroy)
+    return wrapper
+
+def log_in():
+    print("#login#", flush=True)
+    app.update_user_list = watch(app.update_user_list)
+    app.display_message = watch(app.display_message)
+    app.start_session(username)  # what a successful login does
+
+def interactive():
+    print("#interactive#", flush=True)
+    root.after(int(think * 1000), log_in)
+
+root.after_idle(interactive)
+root.mainloop()
+"""
+
+class Output:
+    """Collects a child's stdout with the time each chunk arrived."""
+
+    def __init__(self, proc):
+        self.proc = proc
+        self.data = b""
+        self.cond = threading.Condition()
+        threading.Thread(target=self.read, daemon=True).start()
+
+    def read(self):
+        while True:
+            chunk = self.proc.stdout.read1(65536)
+            with self.cond:
+                if not chunk:
+                    self.cond.notify_all()
+                    return
+                self.data += chunk
+                self.cond.notify_all()
+
+    def wait_for(self, marker, timeout=30):
+        """Return (arrival time, output before the marker)."""
+        with self.cond:
+            if not self.cond.wait_for(lambda: marker in self.data or self.proc.poll() is not None, timeout) \
+                    or marker not in self.data:
+                raise RuntimeError(f"client never printed {marker!r}:\n{self.data.decode(errors='replace')[-2000:]}")
+            return time.perf_counter(), self.data[:self.data.index(marker)]
+
+def import_profile(output):
+    """Milliseconds of top-level imports in -X importtime output, and whether cryptography was loaded."""
+    total = 0
+    crypto = False
+    for line in output.decode(errors="replace").splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        crypto = crypto or name.strip().startswith("cryptography")
+        if not name[1:].startswith(" "):  # nested imports are indented
+            total += int(cumulative)
+    return total / 1000, crypto
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((HOST, port)).close()
+            return
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+def spawn(args, cwd, importtime=False):
+    options = ["-u"] + (["-X", "importtime"] if importtime else [])
+    return subprocess.Popen([sys.executable] + options + args, cwd=cwd,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+def stop(proc):
+    if proc.poll() is None:
+        proc.terminate()
+    proc.wait()
+
+def profile_imports(args, cwd, marker):
+    proc = spawn(args, cwd, importtime=True)
+    try:
+        _, before = Output(proc).wait_for(marker)
+        imports, crypto = import_profile(before)
+        return {"imports": imports, "cryptography": crypto}
+    finally:
+        stop(proc)
+
+def run_cli(client_dir, port, closed_port, username, think):
+    result = profile_imports([CLI, str(closed_port)], client_dir, b"Choose:")
+    start = time.perf_counter()
+    proc = spawn([CLI, str(port)], client_dir)
+    try:
+        output = Output(proc)
+        shown, _ = output.wait_for(b"Choose:")
+        time.sleep(think)
+        entered = time.perf_counter()
+        proc.stdin.write(f"1\n{username}\n{PASSWORD}\n".encode())
+        proc.stdin.flush()
+        online, _ = output.wait_for(b"[Server]:")
+    finally:
+        stop(proc)
+    return dict(result, interactive=(shown - start) * 1000, ready=(online - entered) * 1000)
+
+def gui_args(port, username, think):
+    return ["-c", GUI_DRIVER.format(client_dir=os.path.join(ROOT, 'client')), str(port), username, str(think)]
+
+def run_gui(client_dir, port, closed_port, username, think):
+    result = profile_imports(gui_args(closed_port, username, think), client_dir, b"#interactive#")
+    start = time.perf_counter()
+    proc = spawn(gui_args(port, username, think), client_dir)
+    try:
+        output = Output(proc)
+        shown, _ = output.wait_for(b"#interactive#")
+        entered, _ = output.wait_for(b"#login#")
+        online, _ = output.wait_for(b"#ready#")
+    finally:
+        stop(proc)
+    return dict(result, interactive=(shown - start) * 1000, ready=(online - entered) * 1000)
+
+def gui_imports(client_dir):
+    # Headless: import the module only, which is all the GUI does before its window
+    return profile_imports(["-c", f"import sys; sys.path.insert(0, {os.path.join(ROOT, 'client')!r}); "
+                                  "import gui_client; print('#imported#')"], client_dir, b"#imported#")
+
+def has_display():
+    return sys.platform in ("win32", "darwin") or bool(os.environ.get("DISPLAY"))
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure client cold start")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--think", type=float, default=1.0, help="seconds taken to type the credentials")
+    parser.add_argument("--port", type=int, default=5500, help="server port; the next one must be free")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="chat-startup-")
+    server_dir = os.path.join(workdir, "backend")
+    client_dir = os.path.join(workdir, "client")
+    os.makedirs(server_dir)
+    os.makedirs(client_dir)
+    usernames = [f"{name}{i}" for name in ("cli", "gui") for i in range(args.runs)]
+    with open(os.path.join(client_dir, "users.json"), "w") as f:
+        json.dump({name: hash_password(PASSWORD) for name in usernames}, f)
+    server = subprocess.Popen([sys.executable, SERVER, "--port", str(args.port)], cwd=server_dir,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    results = {}
+    try:
+        wait_for_port(args.port)
+        closed = args.port + 1  # nothing listens here
+        results["cli"] = [run_cli(client_dir, args.port, closed, f"cli{i}", args.think) for i in range(args.runs)]
+        if has_display():
+            results["gui"] = [run_gui(client_dir, args.port, closed, f"gui{i}", args.think) for i in range(args.runs)]
+        else:
+            print("gui: no display, measuring imports only")
+            results["gui"] = [gui_imports(client_dir) for _ in range(args.runs)]
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"median of {args.runs} runs, milliseconds")
+    print(f"{'client':<8}{'measure':>12}{'ms':>9}{'budget':>8}")
+    over = []
+    for client, runs in results.items():
+        for measure, budget in BUDGETS.items():
+            if measure not in runs[0]:
+                continue
+            ms = statistics.median(run[measure] for run in runs)
+            print(f"{client:<8}{measure:>12}{ms:>9.1f}{budget:>8}{'  OVER' if ms > budget else ''}")
+            if ms > budget:
+                over.append(f"{client}/{measure}")
+        if any(run["cryptography"] for run in runs):
+            print(f"{client:<8}  cryptography was imported before the first interaction")
+            over.append(f"{client}/cryptography")
+    if over:
+        print(f"Over budget: {', '.join(over)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
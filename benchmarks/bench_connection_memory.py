@@ -0,0 +1,228 @@
+# bench_connection_memory.py - memory cost of each client connection, with a budget
+#
+# Two measurements, each over N idle then N active connections:
+#   rss        a server process in a temporary directory, VmRSS from /proc
+#              (includes thread stacks and socket buffers)
+#   python     the server run in this process under tracemalloc, counting only
+#              live allocations made by backend code
+# Idle connections log in and stay quiet; active ones also send private messages
+# to themselves. Exits non-zero if any per-connection figure exceeds its budget.
+#
+# Usage: python benchmarks/bench_connection_memory.py [--connections N] [--port P]
+import argparse
+import os
+import selectors
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+BACKEND = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'backend'))
+sys.path.append(BACKEND)
+from rsa_utils import encrypt_message
+from cryptography.hazmat.primitives import serialization
+
+HOST = '127.0.0.1'
+SERVER = os.path.join(BACKEND, 'server.py')
+DONE = b"#done#"
+# Per-connection budgets in KiB; raise them deliberately, not to make a run pass
+RSS_BUDGET_KIB = 64
+PYTHON_BUDGET_KIB = 12
+
+class Drainer:
+    """Reads and discards everything the server sends to the test clients.
+
+    Clients that never read would fill their socket buffers and stall the
+    server's broadcasts. Also notes which clients have seen their DONE marker.
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.tails = {}
+        self.waiting = set()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def add(self, sock):
+        sock.setblocking(False)
+        with self.lock:
+            self.tails[sock] = b""
+            self.selector.register(sock, selectors.EVENT_READ)
+
+    def run(self):
+        while True:
+            with self.lock:
+                empty = not self.tails
+            if empty:
+                time.sleep(0.01)
+                continue
+            for key, _ in self.selector.select(0.1):
+                try:
+                    data = key.fileobj.recv(65536)
+                except (BlockingIOError, OSError):
+                    continue
+                with self.lock:
+                    if key.fileobj not in self.tails:
+                        continue
+                    if not data:
+                        self.selector.unregister(key.fileobj)
+                        del self.tails[key.fileobj]
+                        key.fileobj.close()
+                        continue
+                window = self.tails[key.fileobj] + data
+                if DONE in window:
+                    self.waiting.discard(key.fileobj)
+                self.tails[key.fileobj] = window[1 - len(DONE):]
+
+    def wait_done(self, socks, timeout=60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if not self.waiting.intersection(socks):
+                return True
+            time.sleep(0.05)
+        return False
+
+    def close_all(self):
+        with self.lock:
+            for sock in self.tails:
+                self.selector.unregister(sock)
+                sock.close()
+            self.tails.clear()
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((HOST, port)).close()
+            return
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+def open_connections(port, prefix, count, drainer):
+    socks = []
+    for i in range(count):
+        sock = socket.create_connection((HOST, port))
+        sock.sendall(f"{prefix}{i}".encode())
+        sock.recv(65536)  # the online list: the username was read on its own
+        drainer.add(sock)
+        socks.append(sock)
+    return socks
+
+def make_active(socks, prefix, key, messages, drainer):
+    # Private messages to oneself exercise the receive path without an N^2 broadcast.
+    # One frame in flight per connection, since the protocol has no framing.
+    for n in range(messages):
+        drainer.waiting.update(socks)
+        for i, sock in enumerate(socks):
+            frame = encrypt_message(f"/msg {prefix}{i} message {n} {DONE.decode()}", key)
+            sock.setblocking(True)
+            sock.sendall(frame)
+            sock.setblocking(False)
+        if not drainer.wait_done(socks):
+            raise RuntimeError("active connections did not see their messages delivered")
+
+def settle():
+    time.sleep(1.0)  # let handler threads reach their steady state
+
+def run_phases(port, key, count, messages, measure):
+    """Return [(label, per-connection KiB)] for idle then active connections."""
+    drainer = Drainer()
+    try:
+        settle()
+        base = measure()
+        open_connections(port, "idle", count, drainer)
+        settle()
+        idle = measure()
+        active = open_connections(port, "active", count, drainer)
+        settle()
+        make_active(active, "active", key, messages, drainer)
+        settle()
+        busy = measure()
+        return [("idle", (idle - base) / count / 1024), ("active", (busy - idle) / count / 1024)]
+    finally:
+        drainer.close_all()
+
+def read_rss(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError("VmRSS not found")
+
+def measure_rss(port, count, messages):
+    if not os.path.exists("/proc/self/status"):
+        print("rss: /proc not available, skipped")
+        return []
+    workdir = tempfile.mkdtemp(prefix="chat-mem-")
+    server = subprocess.Popen([sys.executable, SERVER, "--port", str(port)], cwd=workdir,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        with open(os.path.join(workdir, "server_public.pem"), "rb") as f:
+            key = serialization.load_pem_public_key(f.read())
+        return run_phases(port, key, count, messages, lambda: read_rss(server.pid))
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def measure_python(port, count, messages):
+    # The server module works relative to the current directory on import
+    workdir = tempfile.mkdtemp(prefix="chat-mem-")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        tracemalloc.start(25)
+        import server
+        server.event_log.start()  # otherwise unwritten events pile up in the trace
+        threading.stack_size(server.THREAD_STACK_SIZE)
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind((HOST, port))
+        listener.listen(1024)
+        threading.Thread(target=server.serve, args=(listener,), daemon=True).start()
+        only_backend = [tracemalloc.Filter(True, os.path.join(BACKEND, "*"), all_frames=True)]
+
+        def measure():
+            snapshot = tracemalloc.take_snapshot().filter_traces(only_backend)
+            return sum(stat.size for stat in snapshot.statistics("filename"))
+
+        return run_phases(port, server.server_public_key, count, messages, measure)
+    finally:
+        tracemalloc.stop()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure server memory per connection")
+    parser.add_argument("--connections", type=int, default=500, help="idle and active connections each")
+    parser.add_argument("--messages", type=int, default=5, help="messages sent by each active connection")
+    parser.add_argument("--port", type=int, default=5400)
+    parser.add_argument("--rss-budget", type=float, default=RSS_BUDGET_KIB, help="KiB of RSS per connection")
+    parser.add_argument("--python-budget", type=float, default=PYTHON_BUDGET_KIB,
+                        help="KiB of traced Python allocations per connection")
+    args = parser.parse_args()
+
+    results = [("rss", label, kib, args.rss_budget)
+               for label, kib in measure_rss(args.port, args.connections, args.messages)]
+    results += [("python", label, kib, args.python_budget)
+                for label, kib in measure_python(args.port + 1, args.connections, args.messages)]
+
+    print(f"{args.connections} idle + {args.connections} active connections")
+    print(f"{'measure':<8}{'connections':>12}{'KiB/conn':>10}{'budget':>8}")
+    over = []
+    for measure, label, kib, budget in results:
+        print(f"{measure:<8}{label:>12}{kib:>10.1f}{budget:>8.0f}{'  OVER' if kib > budget else ''}")
+        if kib > budget:
+            over.append(f"{measure}/{label}")
+    if over:
+        print(f"Over budget: {', '.join(over)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
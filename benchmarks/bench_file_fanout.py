@@ -0,0 +1,130 @@
+# bench_file_fanout.py - upload bytes saved and fan-out throughput of the file store
+#
+# Starts a server in a temporary directory, connects N receivers and one sender,
+# then sends the same file to every receiver twice:
+#   fan-out    one upload addressed to all receivers
+#   dedup      the same content again, which should skip the upload
+# Upload bytes are compared with one upload per receiver, the old behaviour.
+#
+# Usage: python benchmarks/bench_file_fanout.py [receivers] [file_kb]
+import hashlib
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HOST = '127.0.0.1'
+PORT = 5000
+SERVER = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'backend', 'server.py'))
+
+def connect(username):
+    sock = socket.create_connection((HOST, PORT))
+    sock.sendall(username.encode())
+    sock.recv(4096)
+    return sock
+
+def wait_for_server(timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((HOST, PORT)).close()
+            return
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+class Receiver:
+    """Counts bytes arriving on a connection until a target is reached."""
+
+    def __init__(self, username):
+        self.sock = connect(username)
+        self.received = 0
+        self.target = 0
+        self.done = threading.Event()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def expect(self, nbytes):
+        self.done.clear()
+        self.received = 0
+        self.target = nbytes
+
+    def run(self):
+        while True:
+            data = self.sock.recv(65536)
+            if not data:
+                break
+            self.received += len(data)
+            if self.target and self.received >= self.target:
+                self.done.set()
+
+def wait_response(sock):
+    # Skip join/leave chatter until the server answers the /file command
+    while True:
+        reply = sock.recv(4096).decode(errors="ignore")
+        if "Ready" in reply or "upload skipped" in reply or "[Error:" in reply or "not found" in reply:
+            return reply
+
+def send_file(sock, targets, name, payload, digest):
+    """Send one /file command; returns the number of bytes uploaded."""
+    sock.sendall(f"/file {targets} sha256:{digest} {name}".encode())
+    reply = wait_response(sock)
+    if "upload skipped" in reply:
+        return 0
+    if "Ready" not in reply:
+        raise RuntimeError(reply)
+    sock.sendall(str(len(payload)).ljust(10).encode())
+    sock.sendall(payload)
+    return len(payload)
+
+def run_case(sender, receivers, targets, name, payload, digest):
+    for receiver in receivers:
+        receiver.expect(len(payload))
+    start = time.perf_counter()
+    uploaded = send_file(sender, targets, name, payload, digest)
+    for receiver in receivers:
+        receiver.done.wait(60)
+    elapsed = time.perf_counter() - start
+    delivered = len(payload) * len(receivers)
+    return uploaded, elapsed, delivered / elapsed / (1024 * 1024)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    size_kb = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+
+    workdir = tempfile.mkdtemp(prefix="chat-bench-")
+    server = subprocess.Popen([sys.executable, SERVER], cwd=workdir,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_server()
+        receivers = [Receiver(f"bench_rx{i}") for i in range(count)]
+        sender = connect("bench_tx")
+        time.sleep(0.5)
+
+        targets = ",".join(f"bench_rx{i}" for i in range(count))
+        payload = os.urandom(size_kb * 1024)
+        digest = hashlib.sha256(payload).hexdigest()
+        cases = [
+            ("fan-out",) + run_case(sender, receivers, targets, "bench.bin", payload, digest),
+            ("dedup",) + run_case(sender, receivers, targets, "bench.bin", payload, digest),
+        ]
+
+        # Before the file store every recipient needed its own upload
+        per_user = len(payload) * count
+        print(f"{count} receivers, {size_kb} KiB file")
+        print(f"{'case':<10}{'uploaded KiB':>14}{'seconds':>10}{'fan-out MiB/s':>16}")
+        for label, uploaded, elapsed, throughput in cases:
+            print(f"{label:<10}{uploaded // 1024:>14}{elapsed:>10.3f}{throughput:>16.1f}")
+        for label, uploaded, _, _ in cases:
+            print(f"{label}: {per_user - uploaded} upload bytes saved vs {per_user} for per-user sends")
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
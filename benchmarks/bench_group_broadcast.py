@@ -0,0 +1,199 @@
+# bench_group_broadcast.py - server CPU per broadcast: RSA broadcasts vs encrypt-once rooms
+#
+# Logs N members in to a fresh server and has every member send messages at a
+# steady rate under the per-user limit, over two paths:
+#   rsa    ordinary broadcasts: each message is encrypted to the server's key,
+#          decrypted by the server and re-sent as plaintext to every member
+#   room   room messages: encrypted once by the sender with its sender key and
+#          relayed unchanged; the server never decrypts them
+# Each path gets its own server process, whose CPU time (utime + stime from
+# /proc) is read before and after the messages. Sender keys are distributed
+# in a warm-up round outside the measurement. Every member counts the
+# messages it could read; exits non-zero if any message was lost.
+#
+# Usage: python benchmarks/bench_group_broadcast.py [--members N] [--messages M] [--port P]
+import argparse
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'client'))
+from backend.rsa_utils import encrypt_message
+from client_utils import GroupChat
+from cryptography.hazmat.primitives import serialization
+
+HOST = '127.0.0.1'
+SERVER = os.path.join(ROOT, 'backend', 'server.py')
+ROOM = "bench"
+MARKER = re.compile(rb"#b\d+#")
+TAIL = 15           # longer than any marker but one byte
+SEND_INTERVAL = 0.25  # seconds between a member's messages; the limit is 5/s
+TEXT_SIZE = 120     # characters per message, within RSA's 190-byte limit
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((HOST, port)).close()
+            return
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+def read_cpu(pid):
+    # utime and stime, in clock ticks, follow the state field in /proc/<pid>/stat
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+class Member(threading.Thread):
+    """A logged-in user that counts the broadcast markers it can read."""
+
+    def __init__(self, port, username, key, rooms):
+        super().__init__(daemon=True)
+        self.username = username
+        self.key = key
+        self.sock = socket.create_connection((HOST, port))
+        self.sock.sendall(username.encode())
+        self.sock.recv(65536)  # the online list: the username was read on its own
+        self.group = GroupChat(username) if rooms else None
+        self.received = 0
+        self.unreadable = 0
+        self.errors = 0
+        self.cond = threading.Condition()
+
+    def run(self):
+        pending, tail = b"", b""
+        while True:
+            try:
+                data = pending or self.sock.recv(65536)
+            except OSError:
+                return
+            pending = b""
+            if not data:
+                return
+            if self.group:
+                data, pending, shown = self.group.receive(self.sock, data)
+                if shown:
+                    with self.cond:
+                        self.received += len(MARKER.findall(shown.encode()))
+                        self.unreadable += "could not be decrypted" in shown
+                        self.cond.notify_all()
+            window = tail + data
+            with self.cond:
+                self.received += len(MARKER.findall(window))
+                self.errors += data.count(b"[Error:")
+                self.cond.notify_all()
+            tail = window[-TAIL:] if not MARKER.search(window[-TAIL:]) else b""
+
+    def send(self, seq):
+        text = f"#b{seq}# ".ljust(TEXT_SIZE, "x")
+        if self.group:
+            self.sock.sendall(b"".join(self.group.send(ROOM, text)))
+        else:
+            self.sock.sendall(encrypt_message(text, self.key))
+
+    def wait_until(self, predicate, timeout=30):
+        with self.cond:
+            return self.cond.wait_for(lambda: predicate(self), timeout)
+
+def join_room(members):
+    for count, member in enumerate(members, 1):
+        member.sock.sendall(b"".join(member.group.join(ROOM)))
+        # Join one at a time so every member ends on the same, final epoch
+        for joined in members[:count]:
+            if not joined.wait_until(lambda m: len(m.group.rooms.get(ROOM, (0, {}))[1]) == count):
+                raise RuntimeError(f"{joined.username} never saw {count} members")
+
+def send_round(members, seq):
+    for member in members:
+        seq += 1
+        member.send(seq)
+    return seq
+
+def run_path(path, port, count, messages):
+    workdir = tempfile.mkdtemp(prefix="chat-group-")
+    server = subprocess.Popen([sys.executable, SERVER, "--port", str(port)], cwd=workdir,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        with open(os.path.join(workdir, "server_public.pem"), "rb") as f:
+            key = serialization.load_pem_public_key(f.read())
+        members = [Member(port, f"{path}{i}", key, path == "room") for i in range(count)]
+        for member in members:
+            member.start()
+        seq = 0
+        if path == "room":
+            join_room(members)
+            # Warm-up: the first message from each member also distributes its sender key
+            seq = send_round(members, seq)
+            expected = count - 1
+            for member in members:
+                member.wait_until(lambda m: m.received >= expected)
+            time.sleep(SEND_INTERVAL)
+        baseline = {member: member.received for member in members}
+
+        start = read_cpu(server.pid)
+        began = time.perf_counter()
+        for _ in range(messages):
+            seq = send_round(members, seq)
+            time.sleep(SEND_INTERVAL)
+        expected = messages * (count - 1)
+        delivered = all(member.wait_until(lambda m: m.received - baseline[m] >= expected) for member in members)
+        elapsed = time.perf_counter() - began
+        cpu = read_cpu(server.pid) - start
+
+        broadcasts = messages * count
+        return {
+            "path": path,
+            "cpu_ms": cpu * 1000,
+            "per_broadcast_ms": cpu * 1000 / broadcasts,
+            "per_copy_us": cpu * 1e6 / (broadcasts * (count - 1)),
+            "elapsed": elapsed,
+            "delivered": min(member.received - baseline[member] for member in members) / expected,
+            "complete": delivered,
+            "unreadable": sum(member.unreadable for member in members),
+            "errors": sum(member.errors for member in members),
+        }
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare server CPU per broadcast for RSA broadcasts and rooms")
+    parser.add_argument("--members", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=20, help="messages sent by each member")
+    parser.add_argument("--port", type=int, default=5600)
+    args = parser.parse_args()
+    if not os.path.exists("/proc/self/stat"):
+        print("needs /proc to read the server's CPU time")
+        sys.exit(1)
+
+    results = [run_path("rsa", args.port, args.members, args.messages),
+               run_path("room", args.port + 1, args.members, args.messages)]
+
+    print(f"{args.members} members, {args.members * args.messages} broadcasts per path, "
+          f"{args.members - 1} copies each")
+    print(f"{'path':<6}{'server CPU ms':>15}{'ms/broadcast':>14}{'us/copy':>9}{'delivered':>11}{'errors':>8}")
+    for r in results:
+        print(f"{r['path']:<6}{r['cpu_ms']:>15.0f}{r['per_broadcast_ms']:>14.3f}{r['per_copy_us']:>9.1f}"
+              f"{r['delivered'] * 100:>10.1f}%{r['errors'] + r['unreadable']:>8}")
+    rsa, room = results
+    if room["per_broadcast_ms"]:
+        print(f"rooms use {rsa['per_broadcast_ms'] / room['per_broadcast_ms']:.1f}x less server CPU per broadcast")
+    if not all(r["complete"] and not r["unreadable"] for r in results):
+        print("Some messages were lost or could not be read")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
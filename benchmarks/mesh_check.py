@@ -0,0 +1,164 @@
+# mesh_check.py - start a small federation on localhost and check routing
+#
+# Starts three nodes, each in its own temporary directory, linked as a full mesh,
+# then checks cross-node broadcasts, private messages, multi-node file fan-out,
+# that a user logged in on one node is rejected on another, that messages
+# spooled on one node reach a user who logs in on another, and that a peer
+# without the shared secret cannot inject traffic.
+# Exits non-zero if any check fails.
+#
+# Usage: python benchmarks/mesh_check.py [base_port]
+import hashlib
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from backend.rsa_utils import encrypt_message
+from backend.federation import FRAME, RECONNECT_INTERVAL, SECRET_ENV
+from cryptography.hazmat.primitives import serialization
+
+HOST = '127.0.0.1'
+SERVER = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'backend', 'server.py'))
+NODES = 3
+SECRET = "mesh-check-secret"
+
+def start_nodes(base_port):
+    nodes = []
+    for i in range(NODES):
+        workdir = tempfile.mkdtemp(prefix=f"chat-node{i}-")
+        # Each node dials every node started before it, giving a full mesh
+        peers = ",".join(f"{HOST}:{base_port + 1000 + j}" for j in range(i))
+        cmd = [sys.executable, SERVER, "--port", str(base_port + i), "--node-id", f"node{i}",
+               "--peer-port", str(base_port + 1000 + i), "--peers", peers]
+        proc = subprocess.Popen(cmd, cwd=workdir, env=dict(os.environ, **{SECRET_ENV: SECRET}),
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        nodes.append((proc, workdir, base_port + i))
+    return nodes
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((HOST, port)).close()
+            return
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+def login(username, port):
+    sock = socket.create_connection((HOST, port))
+    sock.sendall(username.encode())
+    time.sleep(0.3)
+    return sock
+
+def drain(sock, timeout=0.5):
+    sock.settimeout(timeout)
+    data = b""
+    try:
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    except socket.timeout:
+        pass
+    return data
+
+def closed_by_peer(sock, timeout=2.0):
+    sock.settimeout(timeout)
+    try:
+        while sock.recv(65536):
+            pass
+        return True
+    except (socket.timeout, ConnectionResetError) as e:
+        return isinstance(e, ConnectionResetError)
+
+def peer_frame(header):
+    encoded = json.dumps(header).encode()
+    return FRAME.pack(len(encoded), 0) + encoded
+
+def main():
+    base_port = int(sys.argv[1]) if len(sys.argv) > 1 else 5200
+    nodes = start_nodes(base_port)
+    failures = []
+
+    def check(label, condition):
+        print(f"[{'ok' if condition else 'FAIL'}] {label}")
+        if not condition:
+            failures.append(label)
+
+    try:
+        for _, _, port in nodes:
+            wait_for_port(port)
+        time.sleep(RECONNECT_INTERVAL + 1.0)  # let every peer link come up
+        keys = []
+        for _, workdir, _ in nodes:
+            with open(os.path.join(workdir, "server_public.pem"), "rb") as f:
+                keys.append(serialization.load_pem_public_key(f.read()))
+
+        alice = login("alice", nodes[0][2])
+        bob = login("bob", nodes[1][2])
+        carol = login("carol", nodes[2][2])
+        online = drain(carol)
+        check("carol sees users on other nodes", b"alice" in online and b"bob" in online)
+        drain(alice), drain(bob)
+
+        duplicate = login("alice", nodes[2][2])
+        check("duplicate login on another node is rejected", b"Duplicate login" in drain(duplicate))
+        duplicate.close()
+        drain(carol)
+
+        alice.sendall(encrypt_message("hello mesh", keys[0]))
+        check("broadcast reaches node1", b"[alice]: hello mesh" in drain(bob))
+        check("broadcast reaches node2", b"[alice]: hello mesh" in drain(carol))
+
+        bob.sendall(encrypt_message("/msg carol psst", keys[1]))
+        check("private message routed to the recipient's node", b"[Private] bob: psst" in drain(carol))
+
+        payload = os.urandom(200 * 1024)
+        digest = hashlib.sha256(payload).hexdigest()
+        carol.sendall(f"/file alice,bob sha256:{digest} mesh.bin".encode())
+        check("file upload accepted", b"Ready" in drain(carol))
+        carol.sendall(str(len(payload)).ljust(10).encode())
+        carol.sendall(payload)
+        check("file sender told of delivery", b"sent successfully to alice, bob" in drain(carol, 1.0))
+        check("file reaches node0", payload in drain(alice, 1.0))
+        check("file reaches node1", payload in drain(bob, 1.0))
+
+        # A peer that skips the secret handshake must not reach anyone
+        intruder = socket.create_connection((HOST, base_port + 1000))
+        intruder.sendall(peer_frame({"type": "hello", "node": "intruder", "nonce": "00"}) +
+                         peer_frame({"type": "broadcast", "from": "carol", "text": "forged"}))
+        check("unauthenticated peer cannot broadcast", b"forged" not in drain(alice) + drain(bob))
+        check("unauthenticated peer link is dropped", closed_by_peer(intruder))
+        intruder.close()
+
+        dave = login("dave", nodes[1][2])
+        dave.close()
+        drain(bob)
+        bob.sendall(encrypt_message("/msg dave see you later", keys[1]))
+        check("private message to an offline user is queued", b"queued for delivery" in drain(bob))
+        dave = login("dave", nodes[2][2])
+        check("queued message follows the user to another node",
+              b"[Private] bob (while you were offline): see you later" in drain(dave, 1.0))
+        dave.close()
+
+        alice.close()
+        check("logout propagates across nodes", b"alice left the chat" in drain(bob))
+    finally:
+        for proc, workdir, _ in nodes:
+            proc.terminate()
+            proc.wait()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+# replay_trace.py - re-drive a recorded traffic trace and report latency/throughput
+#
+# Record a trace with:   python server.py --trace traffic.trace
+# Replay it with:        python benchmarks/replay_trace.py traffic.trace --speed 4 --spawn --report new.json
+# Compare two reports:   python benchmarks/replay_trace.py --diff old.json new.json
+#
+# Every recorded connection becomes a client session. Chat and private messages
+# are re-sent with filler text of the recorded length carrying a sequence marker,
+# so latency is measured from send to first delivery at any session. Files are
+# re-sent with random bytes of the recorded size to as many sessions as before.
+import argparse
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from backend import traffic_trace
+from backend.rsa_utils import encrypt_message
+from cryptography.hazmat.primitives import serialization
+
+HOST = '127.0.0.1'
+PORT = 5000
+SERVER = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'backend', 'server.py'))
+MAX_PLAINTEXT = 190  # RSA-2048 OAEP/SHA-256 limit
+MARKER = re.compile(rb"#r(\d+)#")
+FILE_DONE = ("sent successfully", "queued for delivery", "Failed to send")
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}   # marker seq -> (opcode, send time)
+        self.latencies = {name: [] for name in traffic_trace.OPCODE_NAMES.values()}
+        self.sent = {name: 0 for name in traffic_trace.OPCODE_NAMES.values()}
+        self.rate_limited = 0
+        self.errors = 0
+
+    def sent_frame(self, opcode, seq=None):
+        with self.lock:
+            self.sent[traffic_trace.OPCODE_NAMES[opcode]] += 1
+            if seq is not None:
+                self.pending[seq] = (opcode, time.perf_counter())
+
+    def delivered(self, seq, now):
+        with self.lock:
+            entry = self.pending.pop(seq, None)
+            if entry:
+                self.latencies[traffic_trace.OPCODE_NAMES[entry[0]]].append(now - entry[1])
+
+    def observe(self, opcode, seconds):
+        with self.lock:
+            self.latencies[traffic_trace.OPCODE_NAMES[opcode]].append(seconds)
+
+class Session:
+    def __init__(self, conn_id, stats, key):
+        self.conn_id = conn_id
+        self.username = f"replay{conn_id}"
+        self.stats = stats
+        self.key = key
+        self.sock = socket.create_connection((HOST, PORT))
+        self.sock.sendall(self.username.encode())
+        self.closed = False
+        self.replies = []            # server text replies for the file worker
+        self.reply_event = threading.Event()
+        self.file_lock = threading.Lock()
+        self.searches = []           # send times of outstanding /search requests
+        threading.Thread(target=self.read, daemon=True).start()
+
+    def read(self):
+        tail = b""
+        try:
+            while True:
+                data = self.sock.recv(65536)
+                if not data:
+                    break
+                now = time.perf_counter()
+                window = tail + data
+                for match in MARKER.finditer(window):
+                    self.stats.delivered(int(match.group(1)), now)
+                tail = window[-16:]
+                if data.startswith(b"[Error:"):
+                    with self.stats.lock:
+                        self.stats.rate_limited += b"RATE_LIMITED" in data
+                if data.startswith(b"[Server]:") or data.startswith(b"[Error:"):
+                    text = data.decode(errors="ignore")
+                    if self.searches and ("result(s)" in text or "No matching" in text):
+                        self.stats.observe(traffic_trace.OP_SEARCH, now - self.searches.pop(0))
+                    self.replies.append(text)
+                    self.reply_event.set()
+        except OSError:
+            pass
+
+    def send_text(self, text):
+        self.sock.sendall(encrypt_message(text, self.key))
+
+    def wait_reply(self, words, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            for i, reply in enumerate(self.replies):
+                if any(word in reply for word in words):
+                    del self.replies[i]
+                    return reply
+            self.reply_event.clear()
+            self.reply_event.wait(0.05)
+        return None
+
+    def send_file(self, targets, size):
+        # Runs on its own thread so the schedule keeps moving during uploads
+        with self.file_lock:
+            start = time.perf_counter()
+            try:
+                self.sock.sendall(f"/file {','.join(targets)} replay.bin".encode())
+                reply = self.wait_reply(("Ready", "not found", "[Error:", "No other users"))
+                if not reply or "Ready" not in reply:
+                    with self.stats.lock:
+                        self.stats.errors += 1
+                    return
+                self.sock.sendall(str(size).ljust(10).encode())
+                self.sock.sendall(os.urandom(size))
+                if self.wait_reply(FILE_DONE + ("[Error:",)):
+                    self.stats.observe(traffic_trace.OP_FILE, time.perf_counter() - start)
+            except OSError:
+                pass
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+def filler(seq, size):
+    marker = f"#r{seq}#"
+    size = max(len(marker), min(size, MAX_PLAINTEXT))
+    return marker + "x" * (size - len(marker))
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def replay(records, speed, key):
+    stats = Stats()
+    sessions = {}
+    workers = []
+    slips = []
+    seq = 0
+    first = records[0][0] if records else 0.0
+    start = time.perf_counter()
+    for ts, conn_id, event, opcode, size, arg in records:
+        due = start + (ts - first) / speed
+        delay = due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        slips.append(max(0.0, -delay))
+
+        if event == traffic_trace.CONNECT:
+            sessions[conn_id] = Session(conn_id, stats, key)
+            continue
+        session = sessions.get(conn_id)
+        if session is None or session.closed:
+            continue
+        if event == traffic_trace.DISCONNECT:
+            session.close()
+            continue
+        try:
+            if opcode == traffic_trace.OP_CHAT:
+                seq += 1
+                stats.sent_frame(opcode, seq)
+                session.send_text(filler(seq, size))
+            elif opcode == traffic_trace.OP_PRIVATE:
+                seq += 1
+                target = sessions.get(arg)
+                target_name = target.username if target and not target.closed else "replay_offline"
+                stats.sent_frame(opcode, seq)
+                session.send_text(f"/msg {target_name} " + filler(seq, size))
+            elif opcode == traffic_trace.OP_SEARCH:
+                stats.sent_frame(opcode)
+                session.searches.append(time.perf_counter())
+                session.send_text("/search " + "x" * max(1, min(size, MAX_PLAINTEXT) - 8))
+            elif opcode == traffic_trace.OP_FILE:
+                others = [s.username for s in sessions.values() if s is not session and not s.closed]
+                targets = others[:max(1, arg)] or [session.username]
+                stats.sent_frame(opcode)
+                worker = threading.Thread(target=session.send_file, args=(targets, size), daemon=True)
+                worker.start()
+                workers.append(worker)
+        except OSError:
+            stats.errors += 1
+
+    for worker in workers:
+        worker.join(60)
+    time.sleep(1.0)  # allow the last deliveries to arrive
+    elapsed = time.perf_counter() - start
+    for session in sessions.values():
+        session.close()
+    return stats, elapsed, slips, len(sessions)
+
+def build_report(path, speed, records, stats, elapsed, slips, session_count):
+    frames = sum(stats.sent.values())
+    latency = {}
+    for name, values in stats.latencies.items():
+        if not stats.sent[name]:
+            continue
+        ms = [v * 1000 for v in values]
+        latency[name] = {
+            "sent": stats.sent[name],
+            "measured": len(ms),
+            "p50_ms": percentile(ms, 0.50),
+            "p90_ms": percentile(ms, 0.90),
+            "p99_ms": percentile(ms, 0.99),
+            "max_ms": max(ms) if ms else None,
+        }
+    return {
+        "trace": os.path.basename(path),
+        "speed": speed,
+        "sessions": session_count,
+        "records": len(records),
+        "frames": frames,
+        "duration_s": round(elapsed, 3),
+        "frames_per_s": round(frames / elapsed, 2) if elapsed else None,
+        "rate_limited": stats.rate_limited,
+        "errors": stats.errors,
+        "lost": len(stats.pending),
+        "schedule_slip_p99_ms": (percentile(slips, 0.99) or 0) * 1000,
+        "latency": latency,
+    }
+
+def flatten(report, prefix=""):
+    flat = {}
+    for name, value in report.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + name] = value
+    return flat
+
+def diff_reports(old_path, new_path):
+    with open(old_path) as f:
+        old = flatten(json.load(f))
+    with open(new_path) as f:
+        new = flatten(json.load(f))
+    print(f"{'metric':<32}{'old':>12}{'new':>12}{'change':>10}")
+    for name in sorted(set(old) | set(new)):
+        a, b = old.get(name), new.get(name)
+        change = f"{(b - a) / a * 100:+.1f}%" if a and b is not None else ""
+        fmt = lambda v: "-" if v is None else f"{v:.2f}" if isinstance(v, float) else str(v)
+        print(f"{name:<32}{fmt(a):>12}{fmt(b):>12}{change:>10}")
+
+def main():
+    global PORT
+    parser = argparse.ArgumentParser(description="Replay a chat server traffic trace")
+    parser.add_argument("trace", nargs="?")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed multiplier (default 1x)")
+    parser.add_argument("--spawn", action="store_true", help="start a fresh server in a temporary directory")
+    parser.add_argument("--key", default=os.path.join(os.path.dirname(SERVER), "server_public.pem"),
+                        help="server public key when not spawning")
+    parser.add_argument("--report", help="write the JSON report here")
+    parser.add_argument("--diff", nargs=2, metavar=("OLD", "NEW"), help="compare two reports and exit")
+    args = parser.parse_args()
+
+    if args.diff:
+        diff_reports(*args.diff)
+        return
+    if not args.trace:
+        parser.error("a trace file is required")
+    PORT = args.port
+    _, records = traffic_trace.read_trace(args.trace)
+    records.sort(key=lambda record: record[0])
+
+    server = workdir = None
+    key_path = args.key
+    if args.spawn:
+        workdir = tempfile.mkdtemp(prefix="chat-replay-")
+        server = subprocess.Popen([sys.executable, SERVER, "--port", str(PORT)], cwd=workdir,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        key_path = os.path.join(workdir, "server_public.pem")
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection((HOST, PORT)).close()
+                break
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        with open(key_path, "rb") as f:
+            key = serialization.load_pem_public_key(f.read())
+
+        stats, elapsed, slips, session_count = replay(records, args.speed, key)
+        report = build_report(args.trace, args.speed, records, stats, elapsed, slips, session_count)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(report, indent=2))
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+# restart_check.py - hot restart a server under load and measure the disruption
+#
+# Starts a server with --handoff in a temporary directory, connects N clients
+# that follow the restart protocol (reconnect after the server-chosen delay,
+# then back off with full jitter), starts a slow file upload, and runs a prober
+# that logs in every few milliseconds. Then a second server is started on the
+# same handoff path and takes over. Reports:
+#   accept gap       longest connect and login time seen by the prober
+#   reconnect spread when the clients came back, relative to the restart
+# and checks that nothing was refused, the upload survived, every client came
+# back and the old process exited. Exits non-zero if any check fails.
+#
+# Usage: python benchmarks/restart_check.py [clients] [port]
+import hashlib
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HOST = '127.0.0.1'
+SERVER = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'backend', 'server.py'))
+RECONNECT_SPREAD = (0.5, 5.0)   # matches server.RECONNECT_SPREAD
+RECONNECT_BACKOFF = (0.5, 8.0)  # matches the clients
+RESTART = re.compile(rb"^\x1e\[Restart\] ([\d.]+) 0\n")  # group_utils.restart_frame
+UPLOAD_SIZE = 4 * 1024 * 1024
+UPLOAD_CHUNK = 64 * 1024
+UPLOAD_PAUSE = 0.03             # seconds between chunks, so the upload spans the restart
+
+def start_server(workdir, port):
+    return subprocess.Popen([sys.executable, SERVER, "--port", str(port), "--handoff", "server.handoff"],
+                            cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((HOST, port)).close()
+            return
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+def login(port, username):
+    """Return the socket and the first reply (the online list, maybe more)."""
+    sock = socket.create_connection((HOST, port), timeout=10)
+    sock.sendall(username.encode())
+    first = sock.recv(65536)
+    if not first:
+        raise ConnectionError(f"{username} was not logged in")
+    sock.settimeout(None)
+    return sock, first
+
+class Client(threading.Thread):
+    """Chat client that follows restart notices like the real clients.
+
+    With `keep`, everything received is kept in `data`.
+    """
+
+    def __init__(self, port, username, keep=False):
+        super().__init__(daemon=True)
+        self.port = port
+        self.username = username
+        self.keep = keep
+        self.cond = threading.Condition()
+        self.sock, first = login(port, username)
+        self.data = bytearray(first if keep else b"")
+        self.reconnected = None  # when the login on the new process answered
+        self.retries = 0
+
+    def run(self):
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except OSError:
+                return
+            if not data:
+                return
+            if self.keep:
+                with self.cond:
+                    self.data += data
+                    self.cond.notify_all()
+            match = RESTART.search(data)
+            if match and self.reconnected is None:
+                self.sock.close()
+                time.sleep(float(match.group(1)))
+                self.reconnect()
+
+    def reconnect(self):
+        backoff = RECONNECT_BACKOFF[0]
+        while True:
+            try:
+                self.sock, first = login(self.port, self.username)
+                break
+            except OSError:
+                self.retries += 1
+                time.sleep(random.uniform(0, backoff))
+                backoff = min(backoff * 2, RECONNECT_BACKOFF[1])
+        self.reconnected = time.monotonic()
+        if self.keep:
+            with self.cond:
+                self.data += first
+                self.cond.notify_all()
+
+    def wait_for(self, marker, timeout=30):
+        with self.cond:
+            return self.cond.wait_for(lambda: marker in self.data, timeout)
+
+class Prober(threading.Thread):
+    """Logs in over and over, timing the connect and the first reply."""
+
+    def __init__(self, port):
+        super().__init__(daemon=True)
+        self.port = port
+        self.running = True
+        self.connect_times = []
+        self.login_times = []
+        self.failures = 0
+
+    def run(self):
+        count = 0
+        while self.running:
+            count += 1
+            start = time.monotonic()
+            try:
+                sock = socket.create_connection((HOST, self.port), timeout=10)
+                connected = time.monotonic()
+                sock.sendall(f"probe{count}".encode())
+                if not sock.recv(65536):
+                    raise ConnectionError("closed before the online list")
+                self.connect_times.append(connected - start)
+                self.login_times.append(time.monotonic() - start)
+                sock.close()
+            except OSError:
+                self.failures += 1
+            time.sleep(0.005)
+
+def upload(sender, payload, result):
+    # Slow /file upload that is still running when the restart begins
+    digest = hashlib.sha256(payload).hexdigest()
+    sender.sock.sendall(f"/file receiver sha256:{digest} big.bin".encode())
+    if not sender.wait_for(b"Ready"):
+        return
+    sender.sock.sendall(str(len(payload)).ljust(10).encode())
+    for offset in range(0, len(payload), UPLOAD_CHUNK):
+        sender.sock.sendall(payload[offset:offset + UPLOAD_CHUNK])
+        time.sleep(UPLOAD_PAUSE)
+    # Sent straight away, or spooled if the receiver was already moving
+    result["ok"] = sender.wait_for(b"big.bin' sent successfully") or sender.wait_for(b"queued for delivery", 1)
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 5700
+    workdir = tempfile.mkdtemp(prefix="chat-restart-")
+    old = start_server(workdir, port)
+    new = None
+    failures = []
+
+    def check(label, condition):
+        print(f"[{'ok' if condition else 'FAIL'}] {label}")
+        if not condition:
+            failures.append(label)
+
+    try:
+        wait_for_port(port)
+        clients = [Client(port, f"user{i}") for i in range(count)]
+        sender, receiver = Client(port, "sender", keep=True), Client(port, "receiver", keep=True)
+        for client in clients + [sender, receiver]:
+            client.start()
+        payload = os.urandom(UPLOAD_SIZE)
+        sent = {}
+        uploader = threading.Thread(target=upload, args=(sender, payload, sent), daemon=True)
+        uploader.start()
+        prober = Prober(port)
+        prober.start()
+        time.sleep(0.5)  # upload well under way
+
+        restart = time.monotonic()
+        new = start_server(workdir, port)
+        old_code = old.wait(timeout=90)
+        drained = time.monotonic() - restart
+        uploader.join(30)
+        deadline = time.monotonic() + RECONNECT_SPREAD[1] + 10
+        while time.monotonic() < deadline and not all(client.reconnected for client in clients):
+            time.sleep(0.1)
+        deadline = time.monotonic() + 20
+        while time.monotonic() < deadline and payload not in receiver.data:
+            time.sleep(0.5)
+        time.sleep(0.5)
+        prober.running = False
+        prober.join()
+
+        back = sorted(client.reconnected - restart for client in clients if client.reconnected)
+        print(f"{count} clients, {len(prober.login_times)} probe logins, old process drained in {drained:.2f}s")
+        print(f"accept gap: connect max {max(prober.connect_times) * 1000:.1f} ms, "
+              f"login p99 {percentile(prober.login_times, 0.99) * 1000:.1f} ms, "
+              f"login max {max(prober.login_times) * 1000:.1f} ms")
+        if back:
+            print(f"reconnect spread: first {back[0]:.2f}s, median {percentile(back, 0.5):.2f}s, "
+                  f"last {back[-1]:.2f}s after restart; {sum(c.retries for c in clients)} retries")
+
+        check("no connection refused or dropped during the restart", prober.failures == 0)
+        check("old process exited cleanly", old_code == 0)
+        check("in-flight upload completed", sent.get("ok", False))
+        check("receiver got the whole file", payload in receiver.data)
+        check("every client reconnected", len(back) == count)
+        window = RECONNECT_SPREAD[1] - RECONNECT_SPREAD[0]
+        check("reconnects spread over the jitter window", bool(back) and back[-1] - back[0] > window / 2)
+        try:
+            login(port, "late")[0].close()
+            serving = True
+        except OSError:
+            serving = False
+        check("new process serves after the restart", serving)
+    finally:
+        for proc in (old, new):
+            if proc and proc.poll() is None:
+                proc.terminate()
+                proc.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
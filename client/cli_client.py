@@ -3,13 +3,14 @@ import sys
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import threading
-import socket
-import time
-from backend.rsa_utils import encrypt_message
-from cryptography.hazmat.primitives import serialization
+import hashlib
+import atexit
+from collections import deque
+from datetime import datetime
 from backend.auth_utils import register_user, authenticate_user
+from client_utils import Startup, GroupChat, load_history, save_history, reconnect, restart_delay, HISTORY_LIMIT
 HOST = '127.0.0.1'
-PORT = 5000
+PORT = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
 
 def auth_prompt():
     print("Welcome to Secure Chat 🚪")
@@ -34,42 +35,93 @@ def auth_prompt():
                 print("✅ Login successful.")
         return username
     
-# Load server's public key
-with open("../backend/server_public.pem", "rb") as f:
-    server_public_key = serialization.load_pem_public_key(f.read())
-
-client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-client_socket.connect((HOST, PORT))
+# Connect and load the server's public key while the user logs in
+startup = Startup(HOST, PORT)
 
 # Enter username
 username = auth_prompt()
-client_socket.sendall(username.encode())
+try:
+    client_socket, server_public_key, first_reply = startup.handshake(username)
+except FileNotFoundError:
+    print("[Client]: Server public key not found! Make sure the server is running.")
+    sys.exit(1)
+except OSError as e:
+    print(f"[Client]: Failed to connect to server: {e}")
+    sys.exit(1)
+from backend.rsa_utils import encrypt_message  # already imported by the startup thread
+
+# Show the last session's messages while the server's replies arrive
+recent = deque(load_history(username), maxlen=HISTORY_LIMIT)
+if recent:
+    print("--- Recent messages ---")
+    for timestamp, message in recent:
+        print(f"[{timestamp}] {message}")
+    print("-----------------------")
+atexit.register(lambda: save_history(username, recent))
 
 # Shared variables for thread communication
 file_transfer_mode = False
 file_transfer_lock = threading.Lock()
 pending_server_response = None
 response_event = threading.Event()
+group = None          # room state, created by the first room command
+resume_rooms = False  # rejoin rooms once the new connection has answered
 
-  
-def receive_messages():
-    global file_transfer_mode, pending_server_response
+def group_chat():
+    global group
+    if group is None:
+        group = GroupChat(username)
+    return group
+
+def receive_messages(pending=b""):
+    global client_socket, file_transfer_mode, pending_server_response, resume_rooms
     
     while True:
         try:
-            data = client_socket.recv(4096)
+            data = pending or client_socket.recv(4096)
+            pending = b""
             if not data:
                 break
+            delay = restart_delay(data)
+            if delay is not None:
+                print("\n[Client]: Server restarting, reconnecting...")
+                client_socket.close()
+                client_socket = reconnect(HOST, PORT, username, delay)
+                resume_rooms = group is not None
+                print("[Client]: Reconnected.")
+                print("> ", end="", flush=True)
+                continue
+            if resume_rooms:
+                # Only after the server has read our username
+                resume_rooms = False
+                client_socket.sendall(b"".join(group.resume()))
+            if group:
+                # Room frames carry binary ciphertext; take them off before decoding
+                data, pending, shown = group.receive(client_socket, data)
+                if shown:
+                    print("\n" + shown)
+                    print("> ", end="", flush=True)
+                if not data:
+                    continue
                 
             try:
                 decoded = data.decode()
-                
+
                 # Check if this is a server response to file command
-                if decoded.startswith("[Server]:") and ("Ready" in decoded or "rejected" in decoded or "not found" in decoded):
+                if decoded.startswith("[Server]:") and ("Ready" in decoded or "upload skipped" in decoded or "rejected" in decoded or "not found" in decoded):
                     with file_transfer_lock:
                         pending_server_response = decoded
                         response_event.set()
                     continue
+
+                if decoded.startswith("[Error:"):
+                    # Typed error frame, e.g. rate limiting; may answer a pending /file
+                    print("\n" + decoded)
+                    with file_transfer_lock:
+                        pending_server_response = decoded
+                        response_event.set()
+                    print("> ", end="", flush=True)
+                    continue
                 
                 if decoded.startswith("[File]:"):
                     print("\n" + decoded)
@@ -101,6 +153,8 @@ def receive_messages():
                         print(f"[Client]: File transfer incomplete. Expected {file_size}, got {len(file_data)} bytes")
                 else:
                     print("\n" + decoded)
+                    if not decoded.startswith("[Server]:"):
+                        recent.append((datetime.now().strftime("%H:%M:%S"), decoded))
             except UnicodeDecodeError:
                 print("\n[Client]: Received binary data (file content)")
             
@@ -111,7 +165,7 @@ def receive_messages():
             print(f"[Client] Error receiving message: {e}")
             break
 
-threading.Thread(target=receive_messages, daemon=True).start()
+threading.Thread(target=receive_messages, args=(first_reply,), daemon=True).start()
 
 try:
     while True:
@@ -120,7 +174,7 @@ try:
         if msg.startswith("/file"):
             parts = msg.split(" ", 2)
             if len(parts) < 3:
-                print("[Client]: Usage: /file <username> <file_path>")
+                print("[Client]: Usage: /file <username>[,<username>...|*] <file_path>")
                 continue
 
             _, to_user, file_path = parts
@@ -131,10 +185,16 @@ try:
             file_name = os.path.basename(file_path)
             file_size = os.path.getsize(file_path)
 
+            # Hash first so the server can skip the upload if it already has the content
+            digest = hashlib.sha256()
+            with open(file_path, "rb") as f:
+                for chunk in iter(lambda: f.read(65536), b""):
+                    digest.update(chunk)
+
             print(f"[Client]: Sending file '{file_name}' ({file_size} bytes) to {to_user}...")
 
             # Send file header message (UNENCRYPTED)
-            cmd = f"/file {to_user} {file_name}"
+            cmd = f"/file {to_user} sha256:{digest.hexdigest()} {file_name}"
             client_socket.sendall(cmd.encode())
             
             # Wait for server response using thread communication
@@ -145,6 +205,8 @@ try:
                     pending_server_response = None
                 
                 print(f"[Client]: Server response: {server_response}")
+                if "upload skipped" in server_response:
+                    continue
                 if "Ready" not in server_response:
                     print("[Client]: Server rejected file.")
                     continue
@@ -171,6 +233,22 @@ try:
 
             print(f"[Client]: File '{file_name}' sent successfully to {to_user}.")
 
+        elif msg.startswith(("/join ", "/leave ", "/gmsg ")):
+            # Rooms are end-to-end encrypted; the server only relays them
+            parts = msg.split(" ", 2)
+            try:
+                if parts[0] == "/join":
+                    frames = group_chat().join(parts[1].strip())
+                elif parts[0] == "/leave":
+                    frames = group_chat().leave(parts[1].strip())
+                elif len(parts) < 3:
+                    raise ValueError("Usage: /gmsg <room> <message>")
+                else:
+                    frames = group_chat().send(parts[1], parts[2])
+                client_socket.sendall(b"".join(frames))
+            except ValueError as e:
+                print(f"[Client]: {e}")
+
         else:
             # Regular message - encrypt it
             if len(msg.encode()) > 200:
@@ -0,0 +1,277 @@
+# client_utils.py
+import base64
+import json
+import random
+import socket
+import threading
+import time
+
+KEY_FILE = "../backend/server_public.pem"
+HISTORY_FILE = "recent_history.json"
+HISTORY_LIMIT = 50  # messages kept per user between launches
+RECONNECT_BACKOFF = (0.5, 8.0)  # first retry and cap, in seconds
+
+def load_server_key(path=KEY_FILE):
+    """Return the server's public key, parsed from `path`."""
+    # cryptography is the slowest import of either client; only pay for it here
+    from cryptography.hazmat.primitives import serialization
+    import backend.rsa_utils  # noqa: F401 - warm the encryption path too
+    with open(path, "rb") as f:
+        return serialization.load_pem_public_key(f.read())
+
+def restart_delay(data):
+    """Return the reconnect delay if `data` starts with a server restart notice, else None."""
+    if not data.startswith(b"\x1e"):  # group_utils.FRAME_MARK, without importing it per message
+        return None
+    from backend import group_utils
+    return group_utils.parse_restart(data)
+
+def reconnect(host, port, username, delay, keep_trying=lambda: True):
+    """Log in again after a server restart notice; returns the new socket.
+
+    Waits the server-chosen `delay`, then retries with full-jitter backoff
+    for as long as `keep_trying()` holds, returning None once it does not.
+    """
+    time.sleep(delay)
+    backoff = RECONNECT_BACKOFF[0]
+    while keep_trying():
+        try:
+            sock = socket.create_connection((host, port))
+            sock.sendall(username.encode())
+            return sock
+        except OSError:
+            # Full jitter keeps clients from retrying in lockstep
+            time.sleep(random.uniform(0, backoff))
+            backoff = min(backoff * 2, RECONNECT_BACKOFF[1])
+    return None
+
+class Startup:
+    """Connects to the server and loads its key on a background thread.
+
+    Started before the login prompt, so by the time the user has typed their
+    credentials the socket is open and the key is parsed.
+    """
+
+    def __init__(self, host, port, key_path=KEY_FILE):
+        self.host = host
+        self.port = port
+        self.key_path = key_path
+        self.sock = None
+        self.key = None
+        self.error = None
+        self.done = threading.Event()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        try:
+            self.sock = socket.create_connection((self.host, self.port))
+            self.key = load_server_key(self.key_path)
+        except (OSError, ValueError) as e:
+            self.error = e
+        self.done.set()
+
+    def wait(self):
+        """Return (socket, key), raising whatever stopped the startup."""
+        self.done.wait()
+        if self.error:
+            raise self.error
+        return self.sock, self.key
+
+    def handshake(self, username):
+        """Log in on the early socket; returns (socket, key, the server's first reply).
+
+        The early socket may have gone stale while the user was logging in
+        (e.g. the server restarted). Sending on it usually still succeeds, so
+        only a reply proves it is alive; without one, reconnect and try again.
+        """
+        sock, key = self.wait()
+        try:
+            reply = self._login(sock, username)
+        except OSError:
+            reply = b""
+        if not reply:
+            sock.close()
+            sock = socket.create_connection((self.host, self.port))
+            reply = self._login(sock, username)
+            if not reply:
+                raise ConnectionError("server closed the connection")
+        return sock, key, reply
+
+    def _login(self, sock, username):
+        sock.sendall(username.encode())
+        return sock.recv(4096)
+
+def load_history(username, path=HISTORY_FILE):
+    """Recent messages saved by the last session of `username`."""
+    try:
+        with open(path) as f:
+            return json.load(f).get(username, [])[-HISTORY_LIMIT:]
+    except (OSError, ValueError):
+        return []
+
+def save_history(username, messages, path=HISTORY_FILE):
+    try:
+        with open(path) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        saved = {}
+    saved[username] = list(messages)[-HISTORY_LIMIT:]
+    try:
+        with open(path, "w") as f:
+            json.dump(saved, f)
+    except OSError:
+        pass
+
+class GroupChat:
+    """Client side of encrypt-once group rooms.
+
+    Each message is encrypted once with this client's sender key for the room,
+    and the server relays the same bytes to every member. The sender key
+    reaches each member wrapped with the public key the server's directory
+    lists for them, and is replaced whenever the room's epoch (its membership)
+    changes, so members who left cannot read later messages.
+    """
+
+    def __init__(self, username):
+        # Both import cryptography; by now the startup thread has loaded it
+        from backend import group_utils
+        from backend.rsa_utils import generate_keys
+        self.group_utils = group_utils
+        self.generate_keys = generate_keys
+        self.username = username
+        self.private_key = None
+        self.public_pem = None
+        self.registered = False
+        self.joined = set()
+        self.rooms = {}        # room -> (epoch, {member: public key})
+        self.sender_keys = {}  # room -> (epoch, key) for our own messages
+        self.keys = {}         # (room, sender, epoch) -> key received from that member
+        self.parsed = {}       # public key PEM -> parsed key
+        self.lock = threading.Lock()  # used by the input and receive threads
+
+    def join(self, room):
+        """Frames that register our public key (once) and join `room`."""
+        g = self.group_utils
+        if not g.ROOM_NAME.fullmatch(room):
+            raise ValueError("Room names are 1-32 letters, digits, '_' or '-'.")
+        with self.lock:
+            frames = []
+            if not self.registered:
+                if self.private_key is None:
+                    self.private_key, public_key = self.generate_keys()
+                    self.public_pem = g.public_pem(public_key)
+                frames.append(g.frame("/pubkey", [], self.public_pem))
+                self.registered = True
+            self.joined.add(room)
+            frames.append(g.frame("/join", [room]))
+            return frames
+
+    def leave(self, room):
+        with self.lock:
+            self.joined.discard(room)
+            self._forget_room(room)
+            return [self.group_utils.frame("/leave", [room])]
+
+    def resume(self):
+        """Frames that restore our rooms on a new connection (rooms do not survive a restart)."""
+        with self.lock:
+            rooms = sorted(self.joined)
+            self.registered = False
+            self.joined.clear()
+            for room in rooms:
+                self._forget_room(room)
+        frames = []
+        for room in rooms:
+            frames.extend(self.join(room))
+        return frames
+
+    def _forget_room(self, room):
+        self.rooms.pop(room, None)
+        self.sender_keys.pop(room, None)
+        self.keys = {k: v for k, v in self.keys.items() if k[0] != room}
+
+    def send(self, room, text):
+        """Frames for one message to `room`: a new sender key first if the epoch changed."""
+        g = self.group_utils
+        if len(text) > g.MAX_MESSAGE:
+            raise ValueError(f"Room messages are limited to {g.MAX_MESSAGE} characters.")
+        with self.lock:
+            if room not in self.rooms:
+                raise ValueError(f"Not in room '{room}' (yet); /join it first.")
+            epoch, members = self.rooms[room]
+            frames = []
+            current = self.sender_keys.get(room)
+            if current is None or current[0] != epoch:
+                key = g.new_sender_key()
+                envelopes = {member: base64.b64encode(g.wrap_key(public_key, key)).decode()
+                             for member, public_key in members.items() if member != self.username}
+                frames.append(g.frame("/gkey", [room, str(epoch)], json.dumps(envelopes).encode()))
+                current = self.sender_keys[room] = (epoch, key)
+            frames.append(g.frame("/gmsg", [room, str(epoch)], g.seal(current[1], room, self.username, epoch, text)))
+            return frames
+
+    def receive(self, sock, data):
+        """Take a group frame off the front of `data`, reading the rest of it from `sock`.
+
+        Returns (text, pending, display): `text` is what precedes any group
+        frame, for the caller's usual handling; `pending` is everything after
+        the frame, to be handled next; `display` is a line to show, or None.
+        Frames are only recognised at the frame mark, which the server never
+        lets into chat text, and never inside a file that follows a notice.
+        """
+        g = self.group_utils
+        if data.startswith(b"[File]:"):
+            return data, b"", None
+        start = data.find(g.FRAME_MARK)
+        if start != 0:
+            return (data, b"", None) if start < 0 else (data[:start], data[start:], None)
+        while b"\n" not in data and len(data) < g.MAX_HEADER:
+            chunk = sock.recv(g.MAX_HEADER - len(data))
+            if not chunk:
+                break
+            data += chunk
+        parsed = g.parse_server_frame(data)
+        if parsed is None:
+            # Not a frame we understand; show the rest as text rather than guess a size
+            return data[len(g.FRAME_MARK):], b"", None
+        fields, body, size, rest = parsed
+        while len(body) < size:
+            chunk = sock.recv(size - len(body))
+            if not chunk:
+                break
+            body += chunk
+        try:
+            return b"", rest, self.handle(fields, body)
+        except (ValueError, TypeError, AttributeError):
+            # Bad JSON, key or epoch: drop the frame, keep the connection
+            return b"", rest, f"[Room:{fields[1]}] Ignored a malformed room update."
+
+    def handle(self, fields, body):
+        g = self.group_utils
+        tag, room = fields[0], fields[1]
+        with self.lock:
+            if room not in self.joined:
+                return None
+            if tag == "[Room]":
+                members = {}
+                for member, pem in json.loads(body).items():
+                    if pem not in self.parsed:
+                        self.parsed[pem] = g.load_public_pem(pem.encode())
+                    members[member] = self.parsed[pem]
+                # Messages under the old epoch were all delivered before this update
+                self._forget_room(room)
+                self.rooms[room] = (int(fields[2]), members)
+                return f"[Room:{room}] Members: {', '.join(sorted(members))}"
+            sender, epoch = fields[2], fields[3]
+            if tag == "[GroupKey]":
+                try:
+                    self.keys[(room, sender, epoch)] = g.unwrap_key(self.private_key, base64.b64decode(body))
+                except ValueError:
+                    return f"[Room:{room}] Could not read {sender}'s key."
+                return None
+            key = self.keys.get((room, sender, epoch))
+        try:
+            text = g.open_sealed(key, room, sender, epoch, body) if key else None
+        except Exception:
+            text = None  # tampered with, or sealed for another room or sender
+        return f"[Room:{room}] {sender}: {text if text is not None else '(message could not be decrypted)'}"
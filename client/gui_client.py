@@ -3,45 +3,53 @@ import sys
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import tkinter as tk
-from tkinter import ttk, scrolledtext, messagebox, filedialog, simpledialog
+from tkinter import scrolledtext, messagebox
 import threading
-import socket
-import time
+import hashlib
+from collections import deque
 from datetime import datetime
-from backend.rsa_utils import encrypt_message
-from cryptography.hazmat.primitives import serialization
 from backend.auth_utils import register_user, authenticate_user
+from client_utils import Startup, GroupChat, load_history, save_history, reconnect, restart_delay, HISTORY_LIMIT
 from tkinter import Toplevel, Label, Entry, Button, messagebox
 
+HOST = '127.0.0.1'
+PORT = 5000
+
 class ChatGUI:
-    def __init__(self, root):
+    def __init__(self, root, port=PORT):
         self.root = root
         self.root.title("Secure Chat Client")
         self.root.geometry("1000x700")
         self.root.configure(bg='#2c3e50')
 
-        # Hide main window until login/register is done
-        self.root.withdraw()
-
         # Chat client variables
         self.client_socket = None
         self.username = None
         self.server_public_key = None
+        self.encrypt_message = None
         self.connected = False
         self.users_online = set()
-        
+        self.recent = deque(maxlen=HISTORY_LIMIT)
+        self.group = None           # room state, created by the first room command
+        self.resume_rooms = False   # rejoin rooms once a new connection has answered
+
         # Thread communication
         self.file_transfer_lock = threading.Lock()
         self.pending_server_response = None
         self.response_event = threading.Event()
-        
+
+        # Connect and load the server key while the user logs in
+        self.startup = Startup(HOST, port)
+        self.setup_gui()
         self.show_auth_window()
 
     def show_auth_window(self):
-        auth_window = Toplevel()
+        auth_window = Toplevel(self.root)
         auth_window.title("Login or Register")
         auth_window.geometry("300x200")
-        auth_window.grab_set()  # Make modal
+        auth_window.transient(self.root)
+        auth_window.grab_set()  # Modal, but the main loop keeps running
+        auth_window.protocol("WM_DELETE_WINDOW", self.on_closing)
 
         def handle_auth(mode):
             uname = username_entry.get().strip()
@@ -55,23 +63,14 @@ class ChatGUI:
                 if success:
                     messagebox.showinfo("Success", msg)
                     auth_window.destroy()
-                    self.username = uname
-                    # Show main window and setup GUI
-                    self.root.deiconify()
-                    self.setup_gui()
-                    self.connect_to_server()
+                    self.start_session(uname)
                 else:
                     messagebox.showerror("Error", msg)
 
             elif mode == "Login":
                 if authenticate_user(uname, pwd):
-                    messagebox.showinfo("Success", "Login successful.")
                     auth_window.destroy()
-                    self.username = uname
-                    # Show main window and setup GUI
-                    self.root.deiconify()
-                    self.setup_gui()
-                    self.connect_to_server()
+                    self.start_session(uname)
                 else:
                     messagebox.showerror("Error", "Login failed.")
 
@@ -82,12 +81,23 @@ class ChatGUI:
         Label(auth_window, text="Password").pack()
         password_entry = Entry(auth_window, show="*")
         password_entry.pack()
+        password_entry.bind('<Return>', lambda event: handle_auth("Login"))
 
         Button(auth_window, text="Login", command=lambda: handle_auth("Login")).pack(pady=5)
         Button(auth_window, text="Register", command=lambda: handle_auth("Register")).pack()
+        username_entry.focus_set()
+
+    def start_session(self, username):
+        """Show the cached history at once; log in to the server in the background."""
+        self.username = username
+        self.status_label.config(text=f"Connecting as {username}...", fg='#f39c12')
+        self.recent.extend(load_history(username))
+        for timestamp, message in self.recent:
+            self.add_message(message, "history", timestamp)
+        if self.recent:
+            self.add_message("--- earlier messages above ---", "system")
+        threading.Thread(target=self.connect_to_server, daemon=True).start()
 
-        auth_window.wait_window()  # Wait for user input
-    
     def setup_gui(self):
         # Main container
         main_frame = tk.Frame(self.root, bg='#2c3e50')
@@ -122,6 +132,7 @@ class ChatGUI:
                                       bg='#2c3e50', fg='#ecf0f1',
                                       font=('Arial', 10),
                                       selectbackground='#3498db',
+                                      selectmode=tk.EXTENDED,
                                       relief=tk.FLAT)
         self.users_listbox.pack(fill=tk.BOTH, expand=True, padx=10, pady=(0, 10))
         
@@ -177,57 +188,89 @@ class ChatGUI:
         self.chat_display.tag_configure("file", foreground="#f39c12", font=('Arial', 10, 'bold'))
         self.chat_display.tag_configure("user", foreground="#3498db", font=('Arial', 10, 'bold'))
         self.chat_display.tag_configure("timestamp", foreground="#7f8c8d", font=('Arial', 8))
+        self.chat_display.tag_configure("history", foreground="#7f8c8d", font=('Arial', 10))
         
     def connect_to_server(self):
+        # Runs on its own thread; the socket is usually open by now
         try:
-            if not self.username:
-                messagebox.showerror("Error", "Username not set. Please login first.")
-                return
-            # Load server's public key
             try:
-                with open("../backend/server_public.pem", "rb") as f:
-                    self.server_public_key = serialization.load_pem_public_key(f.read())
+                self.client_socket, self.server_public_key, first_reply = self.startup.handshake(self.username)
             except FileNotFoundError:
-                messagebox.showerror("Error", "Server public key not found! Make sure the server is running.")
-                self.root.destroy()
+                self.root.after(0, self.fail, "Error", "Server public key not found! Make sure the server is running.")
                 return
-            
-            # Connect to server
-            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client_socket.connect(('127.0.0.1', 5000))
-            
-            # Send username
-            self.client_socket.sendall(self.username.encode())
-            
+            from backend.rsa_utils import encrypt_message  # already imported by the startup thread
+            self.encrypt_message = encrypt_message
+
             self.connected = True
             self.status_label.config(text=f"Connected as {self.username}", fg='#27ae60')
             
             # Start receive thread
-            threading.Thread(target=self.receive_messages, daemon=True).start()
+            threading.Thread(target=self.receive_messages, args=(first_reply,), daemon=True).start()
             
             
             self.add_message("Connected to server!", "system")
             
         except Exception as e:
-            messagebox.showerror("Connection Error", f"Failed to connect to server: {e}")
-            self.root.destroy()
-    
-    def receive_messages(self):
+            self.root.after(0, self.fail, "Connection Error", f"Failed to connect to server: {e}")
+
+    def fail(self, title, message):
+        messagebox.showerror(title, message)
+        self.root.destroy()
+
+    def reconnect(self, delay):
+        """Log in again after a server restart notice."""
+        self.client_socket.close()
+        self.status_label.config(text="Server restarting, reconnecting...", fg='#f39c12')
+        sock = reconnect(self.startup.host, self.startup.port, self.username, delay,
+                         keep_trying=lambda: self.connected)
+        if sock is None:
+            return
+        self.client_socket = sock
+        self.resume_rooms = self.group is not None
+        self.status_label.config(text=f"Connected as {self.username}", fg='#27ae60')
+        self.add_message("Reconnected to server.", "system")
+
+    def receive_messages(self, pending=b""):
         while self.connected:
             try:
-                data = self.client_socket.recv(4096)
+                data = pending or self.client_socket.recv(4096)
+                pending = b""
                 if not data:
                     break
+                delay = restart_delay(data)
+                if delay is not None:
+                    self.add_message("Server restarting, reconnecting...", "system")
+                    self.reconnect(delay)
+                    continue
+                if self.resume_rooms:
+                    # Only after the server has read our username
+                    self.resume_rooms = False
+                    self.client_socket.sendall(b"".join(self.group.resume()))
+                if self.group:
+                    # Room frames carry binary ciphertext; take them off before decoding
+                    data, pending, shown = self.group.receive(self.client_socket, data)
+                    if shown:
+                        self.add_message(shown, "system" if "] Members: " in shown else "user")
+                    if not data:
+                        continue
 
                 try:
                     decoded = data.decode()
                     # --- Move this block up ---
-                    if decoded.startswith("[Server]:") and ("Ready" in decoded or "rejected" in decoded or "not found" in decoded or "sent successfully" in decoded):
+                    if decoded.startswith("[Server]:") and ("Ready" in decoded or "upload skipped" in decoded or "rejected" in decoded or "not found" in decoded or "sent successfully" in decoded):
                         with self.file_transfer_lock:
                             self.pending_server_response = decoded
                             self.response_event.set()
                         continue  # Don't process further, this is for file transfer
 
+                    if decoded.startswith("[Error:"):
+                        # Typed error frame, e.g. rate limiting; may answer a pending /file
+                        self.add_message(decoded, "system")
+                        with self.file_transfer_lock:
+                            self.pending_server_response = decoded
+                            self.response_event.set()
+                        continue
+
                     if decoded.startswith("[Server]: Currently online:"):
                         self.update_user_list(decoded)
                     elif decoded.startswith("[File]:"):
@@ -347,9 +390,11 @@ class ChatGUI:
             self.add_message(message, "file")
         else:
             self.add_message(message, "user")
+        if not message.startswith("[Server]"):
+            self.recent.append((datetime.now().strftime("%H:%M:%S"), message))
     
-    def add_message(self, message, tag="user"):
-        timestamp = datetime.now().strftime("%H:%M:%S")
+    def add_message(self, message, tag="user", timestamp=None):
+        timestamp = timestamp or datetime.now().strftime("%H:%M:%S")
         
         self.chat_display.config(state=tk.NORMAL)
         self.chat_display.insert(tk.END, f"[{timestamp}] ", "timestamp")
@@ -364,23 +409,49 @@ class ChatGUI:
         
         self.message_entry.delete(0, tk.END)
         
+        if message.startswith(("/join ", "/leave ", "/gmsg ")):
+            self.send_room_command(message)
+            return
+        
         try:
             if len(message.encode()) > 200:
                 messagebox.showwarning("Message Too Long", "Message too long for RSA encryption. Try breaking it up.")
                 return
             
-            encrypted = encrypt_message(message, self.server_public_key)
+            encrypted = self.encrypt_message(message, self.server_public_key)
             self.client_socket.sendall(encrypted)
             
         except Exception as e:
             messagebox.showerror("Send Error", f"Error sending message: {e}")
     
+    def send_room_command(self, message):
+        # Rooms are end-to-end encrypted; the server only relays them
+        if self.group is None:
+            self.group = GroupChat(self.username)
+        parts = message.split(" ", 2)
+        try:
+            if parts[0] == "/join":
+                frames = self.group.join(parts[1].strip())
+            elif parts[0] == "/leave":
+                frames = self.group.leave(parts[1].strip())
+            elif len(parts) < 3:
+                raise ValueError("Usage: /gmsg <room> <message>")
+            else:
+                frames = self.group.send(parts[1], parts[2])
+                self.add_message(f"[Room:{parts[1]}] You: {parts[2]}", "user")
+            self.client_socket.sendall(b"".join(frames))
+        except ValueError as e:
+            self.add_message(str(e), "system")
+        except OSError as e:
+            messagebox.showerror("Send Error", f"Error sending message: {e}")
+    
     def send_private_message(self):
         selected = self.users_listbox.curselection()
         if not selected:
             messagebox.showwarning("No User Selected", "Please select a user from the list.")
             return
         
+        from tkinter import simpledialog
         target_user = self.users_listbox.get(selected[0])
         message = simpledialog.askstring("Private Message", f"Message to {target_user}:")
         
@@ -391,7 +462,7 @@ class ChatGUI:
                     messagebox.showwarning("Message Too Long", "Message too long for RSA encryption.")
                     return
                 
-                encrypted = encrypt_message(private_msg, self.server_public_key)
+                encrypted = self.encrypt_message(private_msg, self.server_public_key)
                 self.client_socket.sendall(encrypted)
                 
                 # Show in chat that we sent a private message
@@ -406,7 +477,9 @@ class ChatGUI:
             messagebox.showwarning("No User Selected", "Please select a user to send the file to.")
             return
         
-        target_user = self.users_listbox.get(selected[0])
+        # Several selected users share one upload on the server
+        from tkinter import filedialog
+        target_user = ",".join(self.users_listbox.get(i) for i in selected)
         file_path = filedialog.askopenfilename(title="Select File to Send")
         
         if not file_path:
@@ -416,10 +489,16 @@ class ChatGUI:
             file_name = os.path.basename(file_path)
             file_size = os.path.getsize(file_path)
             
+            # Hash first so the server can skip the upload if it already has the content
+            digest = hashlib.sha256()
+            with open(file_path, "rb") as f:
+                for chunk in iter(lambda: f.read(65536), b""):
+                    digest.update(chunk)
+            
             self.add_message(f"Sending file '{file_name}' ({file_size} bytes) to {target_user}...", "system")
             
             # Send file command
-            cmd = f"/file {target_user} {file_name}"
+            cmd = f"/file {target_user} sha256:{digest.hexdigest()} {file_name}"
             self.client_socket.sendall(cmd.encode())
             
             # Wait for server response
@@ -429,6 +508,9 @@ class ChatGUI:
                     server_response = self.pending_server_response
                     self.pending_server_response = None
                 
+                if "upload skipped" in server_response:
+                    self.add_message(f"File '{file_name}' already on server, upload skipped.", "file")
+                    return
                 if "Ready" not in server_response:
                     self.add_message(f"Server rejected file: {server_response}", "system")
                     return
@@ -462,6 +544,8 @@ class ChatGUI:
             self.status_label.config(text=f"Connected as {self.username}")
     
     def on_closing(self):
+        if self.username:
+            save_history(self.username, self.recent)
         self.connected = False
         if self.client_socket:
             self.client_socket.close()
@@ -469,7 +553,7 @@ class ChatGUI:
 
 def main():
     root = tk.Tk()
-    app = ChatGUI(root)
+    app = ChatGUI(root, int(sys.argv[1]) if len(sys.argv) > 1 else PORT)
     root.protocol("WM_DELETE_WINDOW", app.on_closing)
     root.mainloop()
 